@@ -1,6 +1,6 @@
 from pool_generate_all_data import simulate_different_request_rates
 from utils import graph_constructor
-from utils import topologies, shortest_path_modes, xrange, numreqs
+from utils import topologies, shortest_path_modes, xrange, numreqs, crn_seed
 
 if __name__ == '__main__':
 
@@ -13,5 +13,5 @@ if __name__ == '__main__':
             print(f"Simulating {topology} with {spm} shortest-path-mode.")
             G = graph_constructor(topology)
             simulate_different_request_rates(G, topology=topology, shortestpathmode=spm,
-                                             xrange=xrange, num_reqs=numreqs)
+                                             xrange=xrange, num_reqs=numreqs, crn_seed=crn_seed)
             print(f"Simulation for {topology} with {spm} shortest-path-mode completed.")
@@ -1,21 +1,49 @@
+import os
 import random
 from multiprocessing import Pool
 
 import networkx as nx
 import numpy as np
 
-from req_generator import req_generator_uniform
-from simulator import ZeroDetourBus, Network, FixedRouteBus
-from utils import run_or_get_pickle
+from req_generator import req_generator_uniform, req_generator_chunked, req_generator_common, \
+    draw_common_random_numbers
+from simulator import ZeroDetourBus, FixedRouteBus, make_network
+from utils import run_or_get_pickle, pickle_loader, save2pickle, SteadyStateMonitor, ChunkedResultSink, \
+    SimulationProfiler, simulation_mode
 
 
-def simulate_different_request_rates(G, shortestpathmode, topology, xrange, num_reqs):
+def simulate_different_request_rates(G, shortestpathmode, topology, xrange, num_reqs, profile=False, crn_seed=None,
+                                     chunk_dir=None, chunk_size=10 ** 5, target_rel_half_width=None):
+    """
+    Simulates all request rates x in xrange in parallel, num_reqs requests each.
+
+    If a crn_seed is given, all x are simulated with common random numbers: the same origins,
+    destinations and initial position, and the same Poisson arrivals scaled to each rate (see
+    draw_common_random_numbers). The differences between the x are then not blurred by sampling
+    noise, so smooth t_s-vs-x curves need far fewer requests. The numbers are drawn once and
+    saved to ./data/01_simulations/, and the results are saved under the mode including the
+    seed (see simulation_mode).
+
+    If a chunk_dir is given, every x writes its data to a subdirectory of it in chunks of
+    chunk_size requests while simulating (see ChunkedResultSink), so that large num_reqs fit
+    into memory. The statistics are then computed chunk by chunk as well (see calc_single_stats).
+
+    If a target_rel_half_width is given, every x stops as soon as its mean service time is known
+    that precisely (see simulate_single_request_rate), at the latest after num_reqs requests.
+    """
     G.shortest_path_mode = shortestpathmode
-    nG = Network(G, network_type=topology, shortest_path_mode=shortestpathmode)
+    nG = make_network(G, network_type=topology, shortest_path_mode=shortestpathmode)
     l_avg = nx.average_shortest_path_length(G)
 
-    req_args = ((G, nG, x, topology, shortestpathmode, l_avg, num_reqs) for x in
-                xrange)  # generator expression to bundle vars
+    crn_path = None
+    if crn_seed is not None:
+        crn_path = f"./data/01_simulations/{topology}_crn_{crn_seed}_{num_reqs}.npz"
+        if not os.path.exists(crn_path):
+            os.makedirs(os.path.dirname(crn_path), exist_ok=True)
+            draw_common_random_numbers(G, num_reqs, seed=crn_seed, path=crn_path)
+
+    req_args = ((G, nG, x, topology, shortestpathmode, l_avg, num_reqs, profile, crn_path, crn_seed, chunk_dir,
+                 chunk_size, target_rel_half_width) for x in xrange)  # generator expression to bundle vars
 
     with Pool() as pool:
         print("pool opened for worker splash party")
@@ -23,23 +51,88 @@ def simulate_different_request_rates(G, shortestpathmode, topology, xrange, num_
         pool.starmap(simulate_single_request_rate_wrapped, req_args)
 
 
-def simulate_single_request_rate_wrapped(G, nG, x, topology, spm, l_avg, num_reqs):
-    unique_id = f'{topology}_{spm}_{str(x)}'
+def simulate_single_request_rate_wrapped(G, nG, x, topology, spm, l_avg, num_reqs, profile=False, crn_path=None,
+                                         crn_seed=None, chunk_dir=None, chunk_size=10 ** 5, target_rel_half_width=None):
+    unique_id = f'{topology}_{simulation_mode(spm, crn_seed)}_{str(x)}'
+    checkpoint_path = f"./data/01_simulations/{unique_id}_checkpoint.dill"
     wrapped_function = run_or_get_pickle(unique_id, "01_simulations")(simulate_single_request_rate)
-    return wrapped_function(G, nG, x, topology, l_avg, num_reqs)
+    result = wrapped_function(G, nG, x, topology, l_avg, num_reqs,
+                              checkpoint_path=checkpoint_path,
+                              target_rel_half_width=target_rel_half_width,
+                              profile_path=f"./data/01_simulations/{unique_id}_profile.dill" if profile else None,
+                              crn_path=crn_path,
+                              chunk_dir=None if chunk_dir is None else os.path.join(chunk_dir, unique_id),
+                              chunk_size=chunk_size)
+    # only now the result is safely saved
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return result
 
 
-def simulate_single_request_rate(G, nG, x, topology, l_avg, num_reqs):
+def simulate_single_request_rate(G, nG, x, topology, l_avg, num_reqs, checkpoint_path=None,
+                                 target_rel_half_width=None, chunk_dir=None, chunk_size=10 ** 5, profile_path=None,
+                                 crn_path=None, seed=None):
     """
     Simulates only as single request rate x. See the docstring of
     `simulate_different_request_rates` for details on the arguments.
+
+    If a checkpoint_path is given, the simulation is checkpointed there periodically
+    and resumed from it if it exists. The checkpoint is left in place, so that the caller
+    can remove it once the result is saved (see simulate_single_request_rate_wrapped).
+
+    If a target_rel_half_width is given, the simulation stops as soon as the confidence
+    interval of the mean service time is that narrow relative to the mean (see
+    SteadyStateMonitor), at the latest after num_reqs requests.
+
+    Returns req_data, insertion_data and a dict with the driven route (the node labels
+    and times of all stops served, see ZeroDetourBus.route_nodes) and, with early stopping,
+    the steady-state estimate including the warm-up cutoff.
+
+    If a chunk_dir is given, the data is instead written there in chunks of chunk_size
+    requests while simulating (see ChunkedResultSink), which bounds the memory needed.
+    req_data and insertion_data are then returned as None and the dict contains the
+    chunk_dir to read them from (see load_chunked_result).
+
+    If a profile_path is given, the hot path of the simulation is instrumented and the call counts,
+    times and stoplist-length histogram are saved there (see SimulationProfiler).
+
+    If a crn_path is given, the requests and the initial position are replayed from the
+    common random numbers saved there (see draw_common_random_numbers) instead of being drawn.
+    Else, if a seed is given, they are drawn by req_generator_chunked from generators seeded with it
+    instead of the global ones, which makes the run exactly reproducible.
     """
     req_rate = x / (2 * l_avg)
-    sim = ZeroDetourBus(nG,
-                        req_generator_uniform(G, num_reqs, req_rate, topology, anchoring=False),
-                        topology,
-                        random.sample(list(G), k=1)[0]
-                        )
+    crn = None if crn_path is None else dict(np.load(crn_path))
+
+    def req_gen(first_req_idx=0, start_time=0):
+        if crn is not None:
+            return req_generator_common(G, num_reqs, req_rate, crn,
+                                        first_req_idx=first_req_idx, start_time=start_time)
+        if seed is not None:
+            return req_generator_chunked(G, num_reqs, req_rate, seed=seed,
+                                         first_req_idx=first_req_idx, start_time=start_time)
+        return req_generator_uniform(G, num_reqs, req_rate, topology, anchoring=False,
+                                     first_req_idx=first_req_idx, start_time=start_time)
+
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        checkpoint = pickle_loader(checkpoint_path)
+        print(f"resuming x={x} after {checkpoint['num_reqs']} requests from {checkpoint_path}")
+        sim = ZeroDetourBus(nG,
+                            req_gen(first_req_idx=checkpoint['num_reqs'], start_time=checkpoint['last_req_epoch']),
+                            topology,
+                            checkpoint['initpos']
+                            )
+        sim.restore_checkpoint(checkpoint)
+        num_chunks = checkpoint['num_flushed_chunks']
+    else:
+        sim = ZeroDetourBus(nG,
+                            req_gen(),
+                            topology,
+                            list(G)[crn['initpos']] if crn is not None
+                            else list(G)[np.random.default_rng(seed).integers(len(G))] if seed is not None
+                            else random.sample(list(G), k=1)[0]
+                            )
+        num_chunks = 0
     ## we checked the "fixed route bus" (aka conventional public transport) as a sanity check
     # sim = FixedRouteBus(nG,
     #                     req_generator_uniform(G, num_reqs, req_rate),
@@ -47,5 +140,79 @@ def simulate_single_request_rate(G, nG, x, topology, l_avg, num_reqs):
     #                     random.sample(list(G), k=1)[0]
     #                     )
     print(f"simulating x={x}")
-    sim.simulate_all_requests()
-    return sim.req_data, sim.insertion_data
+    steady_state = None if target_rel_half_width is None else SteadyStateMonitor(rel_half_width=target_rel_half_width)
+    sink = None if chunk_dir is None else ChunkedResultSink(chunk_dir, chunk_size, num_chunks=num_chunks)
+    profiler = None if profile_path is None else SimulationProfiler()
+    if profiler is not None:
+        sim.instrument(profiler)
+    sim.simulate_all_requests(checkpoint_path=checkpoint_path, steady_state=steady_state, sink=sink)
+    if profiler is not None:
+        print(profiler.summary())
+        save2pickle(profiler.stats(), profile_path)
+    if sink is not None:
+        extras = dict(chunk_dir=chunk_dir)
+    else:
+        extras = dict(route_nodes=sim.route_nodes, route_times=sim.route_times, node_labels=sim.network.nodes)
+    if steady_state is not None:
+        extras['steady_state'] = sim.steady_state
+    if sink is not None:
+        return None, None, extras
+    return sim.req_data, sim.insertion_data, extras
+
+
+def simulate_single_request_rate_replicas(G, nG, x, topology, l_avg, num_reqs, num_replicas, seed=0):
+    """
+    Like `simulate_single_request_rate`, but simulates num_replicas independent replicas
+    in parallel. Replica r draws its requests and initial position from generators seeded
+    with seed + r (see the seed argument of `simulate_single_request_rate`). Returns a list
+    with the (req_data, insertion_data) of every replica.
+    """
+    replica_args = ((G, nG, x, topology, l_avg, num_reqs, seed + r) for r in range(num_replicas))
+
+    with Pool() as pool:
+        print(f"simulating x={x} with {num_replicas} replicas")
+        return pool.starmap(simulate_replica, replica_args)
+
+
+def simulate_replica(G, nG, x, topology, l_avg, num_reqs, seed):
+    req_data, insertion_data, _ = simulate_single_request_rate(G, nG, x, topology, l_avg, num_reqs, seed=seed)
+    return req_data, insertion_data
+
+
+def simulate_warm_started_replications(G, nG, x, topology, l_avg, num_warmup_reqs, num_reqs, num_replications,
+                                       seed=0):
+    """
+    Simulates num_warmup_reqs requests once to reach steady state, then forks num_replications
+    independent replications of num_reqs requests each from a snapshot of that state
+    (see ZeroDetourBus.snapshot). The warm-up uses the random streams seeded with seed,
+    replication r those seeded with seed + r. Returns a list with the (req_data, insertion_data)
+    of every replication, without the warm-up requests.
+    """
+    req_rate = x / (2 * l_avg)
+    random_state, np_random_state = random.Random(seed), np.random.RandomState(seed)
+    warmup = ZeroDetourBus(nG,
+                           req_generator_uniform(G, num_warmup_reqs, req_rate, topology, anchoring=False,
+                                                 random_state=random_state, np_random_state=np_random_state),
+                           topology,
+                           random_state.sample(list(G), k=1)[0]
+                           )
+    print(f"warming up x={x}")
+    warmup.simulate_all_requests()
+    snapshot = warmup.snapshot()
+
+    results = []
+    for r in range(1, num_replications + 1):
+        sim = ZeroDetourBus.from_snapshot(nG,
+                                          snapshot,
+                                          req_generator_uniform(G, num_warmup_reqs + num_reqs, req_rate, topology,
+                                                                anchoring=False,
+                                                                random_state=random.Random(seed + r),
+                                                                np_random_state=np.random.RandomState(seed + r),
+                                                                first_req_idx=snapshot['num_reqs'],
+                                                                start_time=snapshot['last_req_epoch']),
+                                          topology)
+        print(f"simulating x={x}, replication {r}")
+        sim.simulate_all_requests()
+        results.append((sim.req_data.filter(sim.req_data.column('req_id') > sim.warmup_num_reqs),
+                        sim.insertion_data))
+    return results
@@ -1,25 +1,268 @@
+import os
 import numpy as np
 import random
 
 from simulator import Request
 
 
-def req_generator_uniform(graph, num_reqs, req_rate, topology, anchoring=False):
+def draw_common_random_numbers(graph, num_reqs, seed=0, path=None):
+    """
+    Draws the random numbers of num_reqs uniform requests once, independent of the request rate:
+    the origin and destination (as indices into list(graph), always distinct), the inter-arrival
+    times of a Poisson process with rate 1 and the initial position of the bus. Replaying them at
+    every request rate with req_generator_common (common random numbers) removes the sampling noise
+    between the x of a sweep.
+
+    If a path is given, the numbers are saved there (as .npz) for the workers to load.
+    """
+    rng = np.random.default_rng(seed)
+    num_nodes = len(graph)
+    origins = rng.integers(num_nodes, size=num_reqs)
+    # skipping the origin keeps the destinations uniform over the other nodes
+    destinations = rng.integers(num_nodes - 1, size=num_reqs)
+    destinations += destinations >= origins
+    crn = dict(origins=origins,
+               destinations=destinations,
+               unit_inter_arrival_times=rng.standard_exponential(num_reqs),
+               initpos=rng.integers(num_nodes))
+    if path is not None:
+        np.savez(path, **crn)
+    return crn
+
+
+def req_generator_common(graph, num_reqs, req_rate, crn, first_req_idx=0, start_time=0):
+    """
+    Generates the requests drawn by draw_common_random_numbers (crn: its dict or the path it was
+    saved to) at rate req_rate: the inter-arrival times are scaled by 1 / req_rate, the origins
+    and destinations are the same for every rate. Like req_generator_uniform otherwise,
+    including the arguments to continue an interrupted run.
+    """
+    if isinstance(crn, str):
+        crn = np.load(crn)
+    nodes = list(graph)
+    if num_reqs > len(crn['origins']):
+        raise ValueError(f"Only {len(crn['origins'])} common random numbers were drawn, "
+                         f"but {num_reqs} requests are requested.")
+    origins = crn['origins'][:num_reqs].tolist()
+    destinations = crn['destinations'][:num_reqs].tolist()
+    inter_arrival_times = (crn['unit_inter_arrival_times'][:num_reqs] / req_rate).tolist()
+    if inter_arrival_times:
+        # we put the first request at t=0, see req_generator_uniform
+        inter_arrival_times[0] = 0
+
+    t = start_time
+    for req_idx in range(first_req_idx, num_reqs):
+        t += inter_arrival_times[req_idx]
+        yield Request(req_idx + 1, t, nodes[origins[req_idx]], nodes[destinations[req_idx]])
+
+
+def req_generator_chunked(graph, num_reqs, req_rate, seed=0, chunk_size=2 ** 16, first_req_idx=0, start_time=0):
+    """
+    Like req_generator_uniform (without anchoring), but draws the origins, destinations and
+    inter-arrival times vectorized, chunk_size requests at a time, from np.random.Generator
+    streams derived from seed instead of the global generators. The requests are exactly
+    reproducible per seed.
+
+    Every chunk has its own stream (chunk k is seeded with SeedSequence(seed, spawn_key=(k,))), so an
+    interrupted run continues with the same requests from first_req_idx on (at start_time, the
+    epoch of the last request generated) without redrawing the chunks before.
+    """
+    num_nodes = len(graph)
+
+    def draw_origins_and_destinations(rng, size):
+        origins = rng.integers(num_nodes, size=size)
+        # skipping the origin keeps the destinations uniform over the other nodes
+        destinations = rng.integers(num_nodes - 1, size=size)
+        destinations += destinations >= origins
+        return origins, destinations
+
+    return _chunked_requests(list(graph), num_reqs, req_rate, draw_origins_and_destinations, seed, chunk_size,
+                             first_req_idx, start_time)
+
+
+class AliasTable(object):
+    """
+    Samples indices i with probability proportional to weights[i] in O(1) per draw, vectorized
+    (Walker's alias method, built with Vose's algorithm).
+    """
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=float).ravel()
+        if weights.size == 0 or (weights < 0).any() or not weights.sum() > 0:
+            raise ValueError("The weights have to be non-negative and not all zero.")
+        num_bins = weights.size
+        scaled = (weights * num_bins / weights.sum()).tolist()
+        self.prob = np.ones(num_bins)
+        self.alias = np.arange(num_bins)
+        small = [idx for idx, p in enumerate(scaled) if p < 1]
+        large = [idx for idx, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            idx, alias_idx = small.pop(), large.pop()
+            # bin idx keeps its own weight, the rest of it is filled up from alias_idx
+            self.prob[idx] = scaled[idx]
+            self.alias[idx] = alias_idx
+            scaled[alias_idx] -= 1 - scaled[idx]
+            (small if scaled[alias_idx] < 1 else large).append(alias_idx)
+        # whatever remains is 1 up to rounding errors, and keeps prob 1
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self, rng, size):
+        bins = rng.integers(len(self.prob), size=size)
+        return np.where(rng.random(size) < self.prob[bins], bins, self.alias[bins])
+
+
+def req_generator_od(graph, num_reqs, req_rate, od_weights=None, origin_weights=None, destination_weights=None,
+                     seed=0, chunk_size=2 ** 16, first_req_idx=0, start_time=0):
+    """
+    Like req_generator_chunked, but with non-uniform demand. Either
+
+    - od_weights: an N x N matrix, od_weights[i][j] is the (relative) demand from node i to node j, or
+    - origin_weights and destination_weights: the (relative) demand from and to each node, the
+      destination being drawn by its weight among all nodes but the origin (uniform if not given),
+
+    with the nodes in the order of list(graph). Origins and destinations are always distinct, the
+    diagonal of od_weights is ignored. Both are sampled with the alias method (see AliasTable).
+    """
+    nodes = list(graph)
+    num_nodes = len(nodes)
+    if od_weights is not None:
+        if origin_weights is not None or destination_weights is not None:
+            raise ValueError("Pass either od_weights or origin_weights and destination_weights.")
+        od_weights = np.array(od_weights, dtype=float)
+        if od_weights.shape != (num_nodes, num_nodes):
+            raise ValueError(f"od_weights has to be a {num_nodes} x {num_nodes} matrix.")
+        np.fill_diagonal(od_weights, 0)
+        od_table = AliasTable(od_weights)
+
+        def draw_origins_and_destinations(rng, size):
+            return np.divmod(od_table.sample(rng, size), num_nodes)
+    else:
+        origin_weights = np.ones(num_nodes) if origin_weights is None else origin_weights
+        destination_weights = np.ones(num_nodes) if destination_weights is None else destination_weights
+        origin_table, destination_table = AliasTable(origin_weights), AliasTable(destination_weights)
+        if len(origin_table) != num_nodes or len(destination_table) != num_nodes:
+            raise ValueError("origin_weights and destination_weights need one weight per node.")
+        if np.count_nonzero(destination_weights) < 2:
+            raise ValueError("At least two nodes need a positive destination weight.")
+
+        def draw_origins_and_destinations(rng, size):
+            origins = origin_table.sample(rng, size)
+            destinations = destination_table.sample(rng, size)
+            # redraw the destinations that coincide with their origin
+            coincide = np.flatnonzero(origins == destinations)
+            while coincide.size:
+                destinations[coincide] = destination_table.sample(rng, coincide.size)
+                coincide = coincide[origins[coincide] == destinations[coincide]]
+            return origins, destinations
+
+    return _chunked_requests(nodes, num_reqs, req_rate, draw_origins_and_destinations, seed, chunk_size,
+                             first_req_idx, start_time)
+
+
+TRIP_LOG_COLUMNS = (('time', np.float64), ('origin', np.int32), ('destination', np.int32))
+
+
+def write_trip_log(directory, times, origins, destinations):
+    """
+    Saves a trip log for req_generator_trip_log: one binary .npy file per column in directory,
+    the request times and the origin and destination ids (indices into list(graph)), sorted by time.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    order = np.argsort(times, kind='stable')
+    os.makedirs(directory, exist_ok=True)
+    for (name, dtype), column in zip(TRIP_LOG_COLUMNS, (times, origins, destinations)):
+        np.save(os.path.join(directory, f"{name}.npy"), np.asarray(column, dtype=dtype)[order])
+
+
+def req_generator_trip_log(graph, directory, start=None, end=None, rate_factor=1, chunk_size=2 ** 16,
+                           first_req_idx=0, start_time=0):
+    """
+    Replays the requests of a trip log saved by write_trip_log in time order. The columns are
+    memory-mapped and read chunk_size rows at a time, so the log is never loaded as a whole.
+
+    Only the requests with start <= time < end are replayed (default: all). Epochs are measured
+    from the start of this window (or the first request) and divided by rate_factor, so that e.g.
+    rate_factor=2 replays the same trips at twice the request rate. To continue an interrupted run,
+    pass the number of requests already replayed as first_req_idx; start_time is not needed, as the
+    epochs are read from the log, and only accepted for compatibility with the other generators.
+    """
+    times, origins, destinations = (np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r')
+                                    for name, _ in TRIP_LOG_COLUMNS)
+    nodes = list(graph)
+    first_row = 0 if start is None else int(np.searchsorted(times, start, side='left'))
+    end_row = len(times) if end is None else int(np.searchsorted(times, end, side='left'))
+    if first_row >= end_row:
+        return
+    window_start = times[first_row] if start is None else start
+
+    for chunk_start in range(first_row + first_req_idx, end_row, chunk_size):
+        chunk = slice(chunk_start, min(chunk_start + chunk_size, end_row))
+        epochs = ((times[chunk] - window_start) / rate_factor).tolist()
+        chunk_origins, chunk_destinations = origins[chunk], destinations[chunk]
+        if max(chunk_origins.max(), chunk_destinations.max()) >= len(nodes):
+            raise ValueError(f"The trip log refers to node ids the graph with {len(nodes)} nodes does not have.")
+        for req_idx, epoch, orig, dest in zip(range(chunk.start - first_row + 1, chunk.stop - first_row + 1), epochs,
+                                              chunk_origins.tolist(), chunk_destinations.tolist()):
+            yield Request(req_idx, epoch, nodes[orig], nodes[dest])
+
+
+def _chunked_requests(nodes, num_reqs, req_rate, draw_origins_and_destinations, seed, chunk_size, first_req_idx,
+                      start_time):
+    """
+    The chunked Poisson process behind req_generator_chunked and req_generator_od.
+    draw_origins_and_destinations(rng, size) returns the arrays of origin and destination indices into nodes.
+    """
+    t = start_time
+    if first_req_idx >= num_reqs:
+        return
+    for chunk_idx in range(first_req_idx // chunk_size, -(-num_reqs // chunk_size)):
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(chunk_idx,)))
+        chunk_start = chunk_idx * chunk_size
+        size = min(chunk_size, num_reqs - chunk_start)
+        origins, destinations = draw_origins_and_destinations(rng, size)
+        inter_arrival_times = rng.exponential(1 / req_rate, size=size)
+        if chunk_idx == 0:
+            # we put the first request at t=0, see req_generator_uniform
+            inter_arrival_times[0] = 0
+
+        skip = max(first_req_idx - chunk_start, 0)
+        # accumulated one by one from t, as in req_generator_uniform
+        epochs = np.cumsum(np.concatenate(([t], inter_arrival_times[skip:])))[1:]
+        t = epochs[-1]
+        for req_idx, epoch, orig, dest in zip(range(chunk_start + skip + 1, chunk_start + size + 1),
+                                              epochs.tolist(), origins[skip:].tolist(), destinations[skip:].tolist()):
+            yield Request(req_idx, epoch, nodes[orig], nodes[dest])
+
+
+def req_generator_uniform(graph, num_reqs, req_rate, topology, anchoring=False,
+                          random_state=None, np_random_state=None, first_req_idx=0, start_time=0):
     """
     Generates requests with rate=req_rate whose origin and
     destination are drawn uniformly randomly. The requests
     are generated in time as a Poisson process.
+
+    By default the global random and np.random generators are used. Independent
+    streams (e.g. for warm-started replications) can be passed as random_state (a random.Random)
+    and np_random_state (a np.random.RandomState).
+
+    To continue an interrupted run (see ZeroDetourBus.restore_checkpoint), pass the
+    number of requests already generated as first_req_idx and the epoch of the last
+    one as start_time.
     """
-    t = 0
-    req_idx = 0
+    sample = (random_state or random).sample
+    exponential = (np_random_state or np.random).exponential
+    t = start_time
+    req_idx = first_req_idx
     nodes = list(graph)
     graph_type, N = topology.split('_')
     N = int(N)
 
     if not anchoring:
         while req_idx < num_reqs:
-            orig, dest = random.sample(nodes, k=2)
-            delta_t = np.random.exponential(1 / req_rate)
+            orig, dest = sample(nodes, k=2)
+            delta_t = exponential(1 / req_rate)
 
             if req_idx == 0:  # we put the first request at t=0 - makes reading and controlling the data much easier when 
                 # travel times are always integer times until the end of the simulation
@@ -35,10 +278,10 @@ def req_generator_uniform(graph, num_reqs, req_rate, topology, anchoring=False):
             if req_idx < 100:
                 orig = route_order[req_idx % N]
                 dest = route_order[(req_idx + 1) % N]
-                delta_t = np.random.exponential(1 / req_rate)
+                delta_t = exponential(1 / req_rate)
             else:
-                orig, dest = random.sample(nodes, k=2)
-                delta_t = np.random.exponential(1 / req_rate)
+                orig, dest = sample(nodes, k=2)
+                delta_t = exponential(1 / req_rate)
 
             if req_idx == 0:  # we put the first request at t=0 - makes reading and controlling the data much easier when
                 # travel times are always integer times until the end of the simulation
@@ -103,13 +346,13 @@ def req_generator_uniform(graph, num_reqs, req_rate, topology, anchoring=False):
                 orig = (orig[0] - 1, orig[1] - 1)
                 dest = (dest[0] - 1, dest[1] - 1)
 
-                delta_t = np.random.exponential(1 / req_rate)
+                delta_t = exponential(1 / req_rate)
 
 
 
             else:
-                orig, dest = random.sample(nodes, k=2)
-                delta_t = np.random.exponential(1 / req_rate)
+                orig, dest = sample(nodes, k=2)
+                delta_t = exponential(1 / req_rate)
 
             if req_idx == 0:  # we put the first request at t=0 - makes reading and controlling the data much easier when 
                 # travel times are always integer times until the end of the simulation
@@ -1,13 +1,17 @@
+import random
 import warnings
+from array import array
+from bisect import bisect_right
 from functools import reduce
-from itertools import tee
+from heapq import heappop, heappush
+from itertools import chain, islice, tee
 from math import ceil
-from typing import List
+from operator import or_
 
 import networkx as nx
 import numpy as np
 
-from utils import get_shortest_paths_and_volume
+from utils import get_shortest_paths_and_volume, save2pickle, ReqData, InsertionData
 from tqdm import tqdm
 
 
@@ -22,10 +26,19 @@ def pairwise(iterable):
     return zip(a, b)
 
 
+def popcount(mask):
+    """
+    Number of set bits in mask, i.e. the number of nodes in a volume bitmask.
+    """
+    return bin(mask).count("1")
+
+
 class Stop(object):
     """
     A stop object, to be used in our simulations. Encodes a single stop.
+    The position is the integer node id in the simulated Network.
     """
+    __slots__ = ('position', 'time', 'stop_type', 'req_id')
 
     def __init__(self, position, time, stop_type, req_id):
         self.position = position
@@ -42,6 +55,7 @@ class Request(object):
     """
     A request object, to be used in our simulations. Encodes a single request.
     """
+    __slots__ = ('req_id', 'req_epoch', 'origin', 'destination')
 
     def __init__(self, req_id, req_epoch, origin, destination):
         self.req_id = req_id
@@ -58,7 +72,12 @@ class Network(object):
     """
     A wrapper around nx.Graph. The idea is to  would override key methods
     to make simulations faster.
+
+    This generic implementation computes all its tables from the graph. For the
+    canonical topologies, make_network returns subclasses that build them in closed form.
     """
+    # whether every node pair is served by a single, fixed shortest path. None: decided by network_type
+    UNIQUE_SHORTEST_PATHS = None
 
     def __init__(self, G, network_type, shortest_path_mode='originalpaper'):
         """
@@ -68,6 +87,11 @@ class Network(object):
             network_type: A string. Used for smart route volume
                 computations. If set to 'novolcomp', no route volume
                 computation is performed.
+
+        Internally, nodes are mapped once to contiguous integer ids
+        (self.nodes[idx] is the label of node idx, self.node_index
+        the inverse). All path and distance tables are indexed by
+        these ids.
         """
         self.network_type = network_type
         self.shortest_path_mode = shortest_path_mode
@@ -75,110 +99,757 @@ class Network(object):
         if isinstance(G, Network):
             # If a Network is passed, just copy relevant stuff.
             self._network = G._network
+            self.nodes = G.nodes
+            self.node_index = G.node_index
             self._all_shortest_paths = G._all_shortest_paths
             self.all_path_info = G.all_path_info
             self._all_shortest_path_lengths = G._all_shortest_path_lengths
+            self._dist = G._dist
             self.shortest_path_mode = G.shortest_path_mode
+            self._unique_shortest_paths = self._has_unique_shortest_paths()
+            if network_type == G.network_type:
+                self._volume_masks = G._volume_masks
+                self._between_masks = G._between_masks
+            else:
+                # the volumes depend on the network_type, e.g. there are none for 'novolcomp'
+                self._volume_masks = self._build_volume_masks()
+                self._between_masks = (G._between_masks if G._between_masks is not None and self._volume_masks is not None
+                                       else self._build_between_masks())
+            self._path_nodes = G._path_nodes
+            self._path_offsets = G._path_offsets
         else:
             self._network = nx.Graph(G)
             self._network.shortest_path_mode = shortest_path_mode
-            # Cache all shortest paths
-            if any(topology_with_unique_shortest_paths in self.network_type
-                   for topology_with_unique_shortest_paths in ('cycle', 'line', 'star')):
+            self.nodes = list(self._network)
+            self.node_index = {node: idx for idx, node in enumerate(self.nodes)}
+            self._unique_shortest_paths = self._has_unique_shortest_paths()
+            if self._unique_shortest_paths:
                 warnings.warn(
                     f"Warning: \"network_type\" is set to \"{network_type}\". Any shortest path will be the volume-optimal shortest path.")
-                self._all_shortest_paths, _ = get_shortest_paths_and_volume(self._network, mode="originalpaper")
-            elif self.network_type == "novolcomp" and shortest_path_mode == "all_volume_info":
-                warnings.warn(
-                    "Warning: \"shortest_path_mode\" is set to \"all_volume_info\" (dynamic mode), but \"network_type\" "
-                    "is \"novolcomp\". Using \"static max\" shortest_path_mode instead.")
-                self._all_shortest_paths, _ = get_shortest_paths_and_volume(self._network, mode="staticmax")
-            else:
-                self._all_shortest_paths, self.all_path_info = get_shortest_paths_and_volume(self._network,
-                                                                                             mode=shortest_path_mode)
-            self._all_shortest_path_lengths = dict(nx.all_pairs_shortest_path_length(self._network))
+
+            # dense distance matrix in the smallest unsigned dtype that holds the diameter
+            self._setup_topology()
+            dist = self._build_distances()
+            self._dist = dist.astype(np.min_scalar_type(dist.max()))
+            # nested lists of python ints: faster than numpy scalar indexing for single lookups,
+            # and sums of two distances cannot overflow the compact dtype
+            self._all_shortest_path_lengths = self._dist.tolist()
+
+            # Cache all shortest paths
+            self._build_path_tables()
+            self._volume_masks = self._build_volume_masks()
+            self._between_masks = self._build_between_masks()
+            self._build_hop_tables()
+
+    def _has_unique_shortest_paths(self):
+        if self.UNIQUE_SHORTEST_PATHS is not None:
+            return self.UNIQUE_SHORTEST_PATHS
+        return any(topology_with_unique_shortest_paths in self.network_type
+                   for topology_with_unique_shortest_paths in ('cycle', 'line', 'star'))
+
+    def _setup_topology(self):
+        """
+        Hook for the topology-specialized subclasses: derives the node coordinates the closed-form
+        tables are computed from. Raises ValueError if the graph is not of the expected topology.
+        """
+        pass
+
+    def _check_distances(self, dist):
+        """
+        Verifies a closed-form distance matrix against the graph: the node pairs at distance 1 have
+        to be exactly the edges. This only proves the other distances if the coordinates the formula
+        is computed from describe the complete topology, which _setup_topology has to ensure: then the
+        graph is exactly the network the formula is derived for.
+        """
+        edges = self._network.edges
+        if (len(edges) * 2 != np.count_nonzero(dist == 1)
+                or any(dist[self.node_index[u], self.node_index[v]] != 1 for u, v in edges)):
+            raise ValueError(f"Graph is not a {self.network_type} network")
+
+    def _build_distances(self) -> np.ndarray:
+        """
+        Returns the matrix of all shortest path lengths, indexed by node ids.
+        """
+        num_nodes = len(self.nodes)
+        dist = np.zeros((num_nodes, num_nodes), dtype=np.uint32)
+        for u, lengths in nx.all_pairs_shortest_path_length(self._network):
+            u_idx = self.node_index[u]
+            for v, length in lengths.items():
+                dist[u_idx, self.node_index[v]] = length
+        return dist
+
+    def _build_path_tables(self):
+        """
+        Sets self._all_shortest_paths and, if the volumes are needed, self.all_path_info.
+        """
+        if self._unique_shortest_paths:
+            all_shortest_paths, _ = get_shortest_paths_and_volume(self._network, mode="originalpaper")
+            all_path_info = None
+        elif self.network_type == "novolcomp" and self.shortest_path_mode == "all_volume_info":
+            warnings.warn(
+                "Warning: \"shortest_path_mode\" is set to \"all_volume_info\" (dynamic mode), but \"network_type\" "
+                "is \"novolcomp\". Using \"static max\" shortest_path_mode instead.")
+            all_shortest_paths, _ = get_shortest_paths_and_volume(self._network, mode="staticmax")
+            all_path_info = None
+        else:
+            all_shortest_paths, all_path_info = get_shortest_paths_and_volume(self._network,
+                                                                               mode=self.shortest_path_mode)
+        if all_path_info is all_shortest_paths:
+            # all_volume_info: a single table of the candidate paths and their volumes, translated once
+            self._all_shortest_paths = self.all_path_info = self._index_table(all_shortest_paths)
+        else:
+            self._all_shortest_paths = self._index_table(all_shortest_paths)
+            if all_path_info is not None:
+                # only the volumes are needed, see _build_volume_masks
+                self.all_path_info = self._index_table(all_path_info, volumes_only=True)
+
+    def _build_hop_tables(self):
+        """
+        Stores the path driven from u to v, as chosen by shortest_path, for all node pairs
+        back to back in the flat array self._path_nodes, starting at self._path_offsets[u][v].
+        """
+        num_nodes = len(self.nodes)
+        self._path_nodes = array('i')
+        self._path_offsets = [[0] * num_nodes for _ in range(num_nodes)]
+        for u in range(num_nodes):
+            for v in range(num_nodes):
+                self._path_offsets[u][v] = len(self._path_nodes)
+                self._path_nodes.extend(self.shortest_path(u, v))
+            # closes the last path, see hops
+            self._path_offsets[u].append(len(self._path_nodes))
+
+    def _index_table(self, table, volumes_only=False):
+        """
+        Translates a dict-of-dicts keyed by node labels (as returned by
+        get_shortest_paths_and_volume) into a list-of-lists indexed by node ids.
+        Paths become lists of node ids, volume sets become sets of node ids, and with
+        volumes_only, only the volume sets are kept. Of the candidate paths of all_volume_info,
+        only the first one is kept as path, as it is the only one ever driven (see shortest_path).
+        The rows of table are removed as they are translated, to keep the peak memory low.
+        """
+        node_index = self.node_index
+
+        def to_ids(entry):
+            if volumes_only:
+                return dict(volume_set={node_index[w] for w in entry["volume_set"]})
+            if isinstance(entry, dict):
+                return dict(path=[node_index[w] for w in entry["paths"][0]],
+                            volume_set={node_index[w] for w in entry["volume_set"]})
+            return [node_index[w] for w in entry]
+
+        indexed = []
+        for u in self.nodes:
+            row = table.pop(u)
+            indexed.append([to_ids(row[v]) for v in self.nodes])
+        return indexed
+
+    def _build_volume_masks(self):
+        """
+        Precomputes the route volume of every node pair as a bitmask (a python int, bit n <-> node id n).
+        Shortest paths are symmetric, so the volume of (u, v) is always taken from the pair in id order.
+        """
+        if self.network_type == 'novolcomp':
+            return None
+        elif self._unique_shortest_paths:
+            def volume(u, v):
+                return self._all_shortest_paths[u][v]
+        else:
+            def volume(u, v):
+                return self.all_path_info[u][v]["volume_set"]
+
+        num_nodes = len(self.nodes)
+        masks = [[0] * num_nodes for _ in range(num_nodes)]
+        for u in range(num_nodes):
+            for v in range(u, num_nodes):
+                masks[u][v] = masks[v][u] = reduce(or_, (1 << w for w in volume(u, v)), 0)
+        return masks
+
+    def _build_between_masks(self):
+        """
+        Precomputes for every node pair (u, v) the bitmask of all nodes a with d(u, a) + d(a, v) == d(u, v),
+        i.e. the nodes on any shortest path between u and v. Not needed if volumes are not computed.
+        """
+        if self._volume_masks is None:
+            return None
+        dist = self._dist.astype(np.int64)
+        masks = []
+        for u in range(len(self.nodes)):
+            # row v, column a: is a on a shortest path from u to v?
+            is_between = dist[u][np.newaxis, :] + dist == dist[u][:, np.newaxis]
+            packed = np.packbits(is_between, axis=1, bitorder='little')
+            masks.append([int.from_bytes(row.tobytes(), 'little') for row in packed])
+        return masks
 
     def shortest_path_length(self, u, v, **kwargs):
         return self._all_shortest_path_lengths[u][v]
 
     def shortest_path(self, u, v, **kwargs):
-        if self.shortest_path_mode == 'all_volume_info' and not any(
-                topology_with_unique_shortest_paths in self.network_type
-                for topology_with_unique_shortest_paths in
-                ('cycle', 'line', 'star')):
-            ## i.e. if we want to dynamically choose the volume-maximizing
-            # shortest path depending on the already scheduled route AND it makes sense given the topology
-            scheduled_route_vol = reduce(set.union, (self._all_shortest_paths[u.position][v.position][
-                                                         "volume_set"] for u, v in
-                                                     pairwise(kwargs["stoplist"])), set())
-            volume_optimal_shortest_path_uv = []
-            volume_value = -1
-            for i in range(0, len(self._all_shortest_paths[u][v]["paths"])):
-                if len(self._all_shortest_paths[u][v]["volume_set"] - scheduled_route_vol) > volume_value:
-                    volume_optimal_shortest_path_uv = self._all_shortest_paths[u][v]["paths"][i]
-                    volume_value = len(self._all_shortest_paths[u][v]["volume_set"] - scheduled_route_vol)
-            return volume_optimal_shortest_path_uv
-        else:
-            return self._all_shortest_paths[u][v]
+        paths = self._all_shortest_paths[u][v]
+        if isinstance(paths, dict):
+            # all_volume_info: the volume-maximizing choice scores every candidate by the volume of the
+            # pair (u, v), which is the same for all of them, so the first candidate is always driven
+            return paths["path"]
+        return paths
+
+    def hops(self, u, v):
+        """
+        The number of edges of the path driven from u to v, see node_at_hop.
+        """
+        return self._path_offsets[u][v + 1] - self._path_offsets[u][v] - 1
+
+    def node_at_hop(self, u, v, k):
+        """
+        The node reached after k edges on the path driven from u to v. Equals shortest_path(u, v)[k],
+        but looked up in constant time without building the path.
+        """
+        return self._path_nodes[self._path_offsets[u][v] + k]
 
     def nodes_enroute(self, s, t):
         """
         Returns all the nodes that are on the route when one goes from
         s to t. Basically this is the set of all nodes in all
         shortest paths between s and t.
+
+        The set is encoded as a bitmask: bit n is set iff node id n is on the route.
         """
-        if any(topology_with_unique_shortest_paths in self.network_type
-               for topology_with_unique_shortest_paths in ('cycle', 'line', 'star')):
-            return set(self.shortest_path(s, t))
-        elif self.network_type == 'novolcomp':
+        if self._volume_masks is None:
             # forcibly disable volume computation
-            return set()
+            return 0
+        return self._volume_masks[s][t]
+
+    def nodes_between(self, s, t):
+        """
+        Like nodes_enroute, but always the bitmask of all nodes on any shortest path between s and t,
+        independent of the network_type.
+        """
+        if self._between_masks is None:
+            return 0
+        return self._between_masks[s][t]
+
+    def first_leg_between(self, a, positions):
+        """
+        Vectorized _is_between over a whole route: evaluates d(u, a) + d(a, v) == d(u, v) for all
+        consecutive (u, v) in the integer array positions at once and returns the index of the first
+        leg for which it holds, or None.
+        """
+        u, v = positions[:-1], positions[1:]
+        is_between = np.add(self._dist[u, a], self._dist[a, v], dtype=np.int64) == self._dist[u, v]
+        if not is_between.size:
+            return None
+        leg_idx = int(is_between.argmax())
+        return leg_idx if is_between[leg_idx] else None
+
+
+def _walk_order(graph, start):
+    """
+    Walks a path or cycle graph from start, always stepping to the first unvisited neighbor.
+    Returns the nodes in the order visited.
+    """
+    order = [start]
+    visited = {start}
+    node = start
+    while True:
+        node = next((w for w in graph.adj[node] if w not in visited), None)
+        if node is None:
+            return order
+        visited.add(node)
+        order.append(node)
+
+
+class LineNetwork(Network):
+    """
+    A line network. Node ids are placed along the line, distances are |x_u - x_v| and the unique
+    shortest path is the stretch of the line in between.
+    """
+    UNIQUE_SHORTEST_PATHS = True
+
+    def _setup_topology(self):
+        endpoint = next((node for node in self.nodes if self._network.degree[node] <= 1), self.nodes[0])
+        order = [self.node_index[node] for node in _walk_order(self._network, endpoint)]
+        if len(order) != len(self.nodes):
+            raise ValueError(f"Graph is not a {self.network_type} network")
+        self._order = order
+        self._coord = np.empty(len(order), dtype=np.int64)
+        self._coord[order] = np.arange(len(order))
+
+    def _build_distances(self):
+        dist = np.abs(self._coord[:, np.newaxis] - self._coord[np.newaxis, :])
+        self._check_distances(dist)
+        return dist
+
+    def _build_path_tables(self):
+        order = self._order
+        coord = self._coord.tolist()
+        paths = []
+        for u in range(len(order)):
+            x_u = coord[u]
+            paths.append([order[x_u:coord[v] + 1] if coord[v] >= x_u else order[coord[v]:x_u + 1][::-1]
+                          for v in range(len(order))])
+        self._all_shortest_paths = paths
+
+
+class CycleNetwork(Network):
+    """
+    A cycle network. Node ids are placed around the cycle, distances are min(|x_u - x_v|, n - |x_u - x_v|)
+    and the shortest path goes the short way round. For the antipodal nodes of an even cycle it goes
+    towards the first neighbor in the adjacency of the origin, like nx.all_pairs_shortest_path.
+    """
+    UNIQUE_SHORTEST_PATHS = True
+
+    def _setup_topology(self):
+        order = [self.node_index[node] for node in _walk_order(self._network, self.nodes[0])]
+        if len(order) != len(self.nodes):
+            raise ValueError(f"Graph is not a {self.network_type} network")
+        self._order = order
+        self._coord = np.empty(len(order), dtype=np.int64)
+        self._coord[order] = np.arange(len(order))
+
+    def _build_distances(self):
+        num_nodes = len(self._order)
+        dist = np.abs(self._coord[:, np.newaxis] - self._coord[np.newaxis, :])
+        dist = np.minimum(dist, num_nodes - dist)
+        self._check_distances(dist)
+        return dist
+
+    def _build_path_tables(self):
+        order = self._order
+        num_nodes = len(order)
+        coord = self._coord.tolist()
+        # walking the cycle twice, every path is a slice (forwards or backwards)
+        ring = order + order
+        paths = []
+        for u in range(num_nodes):
+            x_u = coord[u]
+            first_neighbor = self.node_index[next(iter(self._network.adj[self.nodes[u]]))]
+            ties_forward = coord[first_neighbor] == (x_u + 1) % num_nodes
+            paths_u = []
+            for v in range(num_nodes):
+                forward = (coord[v] - x_u) % num_nodes
+                if forward < num_nodes - forward or (forward == num_nodes - forward and ties_forward):
+                    paths_u.append(ring[x_u:x_u + forward + 1])
+                else:
+                    backward = (num_nodes - forward) % num_nodes
+                    paths_u.append(ring[x_u + num_nodes - backward:x_u + num_nodes + 1][::-1])
+            paths.append(paths_u)
+        self._all_shortest_paths = paths
+
+
+class StarNetwork(Network):
+    """
+    A star network. Distances are 1 from and to the center, 2 between leaves, where the unique
+    shortest path passes through the center.
+    """
+    UNIQUE_SHORTEST_PATHS = True
+
+    def _setup_topology(self):
+        self._center = self.node_index[max(self.nodes, key=self._network.degree)]
+
+    def _build_distances(self):
+        num_nodes = len(self.nodes)
+        dist = np.full((num_nodes, num_nodes), 2, dtype=np.int64)
+        dist[self._center, :] = dist[:, self._center] = 1
+        np.fill_diagonal(dist, 0)
+        self._check_distances(dist)
+        return dist
+
+    def _build_path_tables(self):
+        c = self._center
+        paths = []
+        for u in range(len(self.nodes)):
+            if u == c:
+                paths.append([[c] if v == c else [c, v] for v in range(len(self.nodes))])
+            else:
+                paths.append([[u] if v == u else [u, v] if v == c else [u, c, v] for v in range(len(self.nodes))])
+        self._all_shortest_paths = paths
+
+
+class WheelNetwork(Network):
+    """
+    A wheel network. Distances are 1 from and to the hub and min(cyclic distance, 2) on the rim.
+    Shortest paths are not unique, so the candidate paths and their volumes are still enumerated
+    by the generic implementation.
+    """
+    UNIQUE_SHORTEST_PATHS = False
+
+    def _setup_topology(self):
+        hub = max(self.nodes, key=self._network.degree)
+        rim = self._network.subgraph(node for node in self.nodes if node != hub)
+        order = [self.node_index[node] for node in _walk_order(rim, next(iter(rim)))] if len(rim) else []
+        if len(order) != len(self.nodes) - 1:
+            raise ValueError(f"Graph is not a {self.network_type} network")
+        self._hub = self.node_index[hub]
+        self._coord = np.zeros(len(self.nodes), dtype=np.int64)
+        self._coord[order] = np.arange(len(order))
+
+    def _build_distances(self):
+        num_rim_nodes = len(self.nodes) - 1
+        dist = np.abs(self._coord[:, np.newaxis] - self._coord[np.newaxis, :])
+        dist = np.minimum(np.minimum(dist, num_rim_nodes - dist), 2)
+        dist[self._hub, :] = dist[:, self._hub] = 1
+        np.fill_diagonal(dist, 0)
+        self._check_distances(dist)
+        return dist
+
+
+class GridNetwork(Network):
+    """
+    A square grid network with nodes labelled by their coordinates (i, j), as built by
+    nx.grid_2d_graph. Distances are Manhattan distances. Shortest paths are not unique, so the
+    candidate paths and their volumes are still enumerated by the generic implementation.
+    """
+    UNIQUE_SHORTEST_PATHS = False
+
+    def _setup_topology(self):
+        try:
+            self._coord = np.array([[int(i), int(j)] for i, j in self.nodes], dtype=np.int64).reshape(-1, 2)
+        except (TypeError, ValueError):
+            raise ValueError(f"Graph is not a {self.network_type} network")
+        # every cell of the bounding rectangle exactly once, else Manhattan distances are not graph distances
+        num_coords = len({tuple(coord) for coord in self._coord.tolist()})
+        extent = self._coord.max(axis=0) - self._coord.min(axis=0) + 1 if len(self.nodes) else (0, 0)
+        if num_coords != len(self.nodes) or extent[0] * extent[1] != len(self.nodes):
+            raise ValueError(f"Graph is not a complete {self.network_type} network")
+
+    def _build_distances(self):
+        dist = np.abs(self._coord[:, np.newaxis, :] - self._coord[np.newaxis, :, :]).sum(axis=2)
+        self._check_distances(dist)
+        return dist
+
+
+_TOPOLOGY_NETWORKS = {
+    'line': LineNetwork,
+    'cycle': CycleNetwork,
+    'star': StarNetwork,
+    'wheel': WheelNetwork,
+    'grid': GridNetwork,
+}
+
+
+def make_network(G, network_type, shortest_path_mode='originalpaper') -> Network:
+    """
+    Returns the Network for G, specialized to its topology where the network_type names one of the
+    canonical topologies (e.g. 'grid_16') and generic otherwise. A Network passed as G is copied
+    with its own type.
+    """
+    if isinstance(G, Network):
+        return type(G)(G, network_type=network_type, shortest_path_mode=shortest_path_mode)
+    network_class = _TOPOLOGY_NETWORKS.get(network_type.split('_')[0], Network)
+    try:
+        return network_class(G, network_type=network_type, shortest_path_mode=shortest_path_mode)
+    except ValueError as error:
+        warnings.warn(f"Warning: {error}. Using the generic Network instead.")
+        return Network(G, network_type=network_type, shortest_path_mode=shortest_path_mode)
+
+
+class _StopBlock(object):
+    """
+    A block of consecutive stops of a Stoplist, stored as columns. For the leg from every stop
+    to its successor it also holds the route volume mask (used for the statistics and the
+    en-route decision) and the between mask (all nodes on any shortest path of the leg, used to
+    find the leg a stop is inserted into), as well as the OR of each over the block.
+    """
+    __slots__ = ('positions', 'times', 'stop_types', 'req_ids', 'volumes', 'betweens', 'volume', 'between')
+
+    def __init__(self, positions, times, stop_types, req_ids, volumes, betweens):
+        self.positions = positions
+        self.times = times
+        self.stop_types = stop_types
+        self.req_ids = req_ids
+        self.volumes = volumes
+        self.betweens = betweens
+        self.update()
+
+    def __len__(self):
+        return len(self.positions)
+
+    def columns(self):
+        return self.positions, self.times, self.stop_types, self.req_ids, self.volumes, self.betweens
+
+    def update(self, start=0):
+        """
+        Recomputes the block masks from the legs from start on.
+        """
+        self.volume = reduce(or_, self.volumes[start:], 0)
+        self.between = reduce(or_, self.betweens[start:], 0)
+
+
+class Stoplist(object):
+    """
+    The stops scheduled for a bus, in order of service. Under the zero-detour policy stop times
+    never change after insertion, so the stops are also sorted by time.
+
+    The stops are stored in blocks of at most 2 * BLOCK_SIZE stops, each block holding one column
+    per stop attribute (see _StopBlock). Inserting at any position is a list insert into a single
+    block after skipping whole blocks, i.e. O(BLOCK_SIZE + n / BLOCK_SIZE). As BLOCK_SIZE is fixed,
+    this is still linear in n, but with a constant about BLOCK_SIZE times smaller than a flat list for
+    long stoplists; it is only close to O(sqrt n) for stoplists of around BLOCK_SIZE ** 2 stops. The
+    simulator reads the columns through the *_at accessors; Stop objects are only created when the
+    stoplist is indexed or iterated. Served stops are not deleted from the first block right away
+    but skipped by advancing a head pointer, and a stop inserted at the front reuses the slot in
+    front of the head; a block is only dropped once all its stops are served.
+
+    Alongside the stops, the volume bitmask of every leg (the route from a stop to its successor,
+    0 for the last stop) is maintained incrementally, and each block caches the OR of its legs, so
+    that the volume of the whole route or of the rest of the route from any stop on is an OR over
+    a partial block and the block masks instead of a scan over all legs.
+
+    The cached block masks double as a two-level index from nodes to legs: bit n of a block's
+    between mask tells whether any leg in the block passes node n, so the first leg passing a
+    node is found by skipping blocks and then testing single legs of one block.
+    """
+    BLOCK_SIZE = 32
+
+    def __init__(self, network):
+        self.network = network
+        self._blocks = [_StopBlock([], [], [], [], [], [])]
+        # offset of the first stop in the first block, all stops before it are served
+        self._head = 0
+        self._size = 0
+        # volume of the whole route, cached until the stoplist changes
+        self._route_volume = None
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        first_block, *other_blocks = self._blocks
+        yield from map(Stop, *(islice(column, self._head, None) for column in first_block.columns()[:4]))
+        for block in other_blocks:
+            yield from map(Stop, *block.columns()[:4])
+
+    def __getitem__(self, idx):
+        block_idx, offset = self._locate_stop(idx)
+        return Stop(*(column[offset] for column in self._blocks[block_idx].columns()[:4]))
+
+    def __repr__(self):
+        return f"Stoplist({list(self)})"
+
+    def position_at(self, idx):
+        block_idx, offset = self._locate_stop(idx)
+        return self._blocks[block_idx].positions[offset]
+
+    def time_at(self, idx):
+        block_idx, offset = self._locate_stop(idx)
+        return self._blocks[block_idx].times[offset]
+
+    def stop_type_at(self, idx):
+        block_idx, offset = self._locate_stop(idx)
+        return self._blocks[block_idx].stop_types[offset]
+
+    def req_id_at(self, idx):
+        block_idx, offset = self._locate_stop(idx)
+        return self._blocks[block_idx].req_ids[offset]
+
+    def count_until(self, t):
+        """
+        Returns the number of stops with a time of at most t. Since the stops are sorted by time,
+        whole blocks are skipped and the last one is bisected.
+        """
+        count = -self._head
+        for block in self._blocks:
+            if block.times and block.times[-1] <= t:
+                count += len(block)
+            else:
+                return count + bisect_right(block.times, t, lo=self._head if block is self._blocks[0] else 0)
+        return count
+
+    def insert(self, idx, position, time, stop_type, req_id):
+        """
+        Inserts a stop before position idx and updates the volumes of the affected legs.
+        Like list.insert, an idx past the end appends.
+        """
+        is_head_or_tail = idx <= 0 or idx >= len(self)
+        idx = min(idx, len(self))
+        if idx == 0 and self._head > 0:
+            self._head -= 1
+            block_idx, offset = 0, self._head
+            block = self._blocks[0]
+            for column, value in zip(block.columns(), (position, time, stop_type, req_id)):
+                column[offset] = value
         else:
-            return self.all_path_info[s][t]["volume_set"]
-
-    def all_reachable_nodes_on_stoplist(self, stoplist) -> set:
-        # this is a sped-up operation to get all nodes on the route between all pairs of stops in the stoplist
-        checked_routes_directed = set()
-        node_set = set()
-        for u, v in pairwise(stoplist):
-            u_pos, v_pos = u.position, v.position
-            # since shortest-paths are symmetric, we only need to check each route once and direction doesnt matter
-            u_pos, v_pos = sorted((u_pos, v_pos))
-            if (u_pos, v_pos) not in checked_routes_directed:
-                # add all nodes on the route from u to v that aren't already in the node_set
-                nodes_on_route = self.nodes_enroute(u_pos, v_pos)
-                node_set |= nodes_on_route
-
-                # add the route to the set of checked routes
-                checked_routes_directed.add(tuple((u_pos, v_pos)))
-                # but also add all subroutes to the set of checked routes
-                checked_routes_directed |= set(tuple(sorted((u_pos, w_pos))) for w_pos in nodes_on_route)
-        return node_set
+            block_idx, offset = self._locate(idx)
+            block = self._blocks[block_idx]
+            for column, value in zip(block.columns(), (position, time, stop_type, req_id, 0, 0)):
+                column.insert(offset, value)
+        self._size += 1
+
+        volume, between = block.volumes[offset], block.betweens[offset] = self._leg_masks(block_idx, offset)
+        block.volume |= volume
+        block.between |= between
+        if idx > 0:
+            # the predecessor now leads to the new stop
+            volume |= self._update_leg(*self._predecessor(block_idx, offset))
+        if self._route_volume is not None:
+            if is_head_or_tail:
+                # no existing leg was replaced, so the route can only have grown by the new legs
+                self._route_volume |= volume
+            else:
+                self._route_volume = None
+        if len(block) > 2 * self.BLOCK_SIZE:
+            self._split_block(block_idx)
+
+    def drop_head(self, count):
+        """
+        Removes the first count stops. Legs behind them are unaffected.
+        """
+        count = min(count, len(self))
+        self._size -= count
+        self._head += count
+        while len(self._blocks) > 1 and self._head >= len(self._blocks[0]):
+            self._head -= len(self._blocks[0])
+            del self._blocks[0]
+        if self._head == len(self._blocks[0]):
+            # everything is served
+            for column in self._blocks[0].columns():
+                column.clear()
+            self._head = 0
+        self._blocks[0].update(self._head)
+        self._route_volume = None
+
+    def volume(self, start=0) -> int:
+        """
+        Returns the bitmask of all nodes on the route from stop start to the last stop.
+        """
+        if start == 0 and self._route_volume is not None:
+            return self._route_volume
+        block_idx, offset = self._locate(start)
+        partial_block_mask = reduce(or_, self._blocks[block_idx].volumes[offset:], 0)
+        volume = reduce(or_, (block.volume for block in self._blocks[block_idx + 1:]), partial_block_mask)
+        if start == 0:
+            self._route_volume = volume
+        return volume
+
+    def between(self) -> int:
+        """
+        Returns the bitmask of all nodes on any shortest path of any leg of the route.
+        """
+        first_block = self._blocks[0]
+        return reduce(or_, (block.between for block in self._blocks[1:]),
+                      reduce(or_, first_block.betweens[self._head:], 0))
+
+    def positions(self, start=0) -> np.ndarray:
+        """
+        Returns the positions of the stops from start on as an integer array.
+        """
+        block_idx, offset = self._locate(start)
+        return np.fromiter(chain(islice(self._blocks[block_idx].positions, offset, None),
+                                 *(block.positions for block in self._blocks[block_idx + 1:])),
+                           dtype=np.intp, count=max(len(self) - start, 0))
+
+    def first_leg_through(self, node, start=0):
+        """
+        Returns the index of the first stop from start on whose leg to its successor lies on a
+        shortest path through node, or None if there is no such leg.
+        """
+        block_idx, offset = self._locate(start)
+        leg_idx = start - offset
+        for block in self._blocks[block_idx:]:
+            if block.between >> node & 1:
+                for leg_offset in range(offset, len(block)):
+                    if block.betweens[leg_offset] >> node & 1:
+                        return leg_idx + leg_offset
+            leg_idx += len(block)
+            offset = 0
+        return None
+
+    def _locate(self, idx):
+        """
+        Returns the block and the offset inside that block of the stop idx.
+        idx == len(self) locates the end of the last block.
+        """
+        idx += self._head
+        for block_idx, block in enumerate(self._blocks):
+            if idx < len(block):
+                return block_idx, idx
+            idx -= len(block)
+        return len(self._blocks) - 1, len(self._blocks[-1]) + idx
+
+    def _locate_stop(self, idx):
+        """
+        Like _locate, but for an existing stop. Negative indices count from the end.
+        """
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("stoplist index out of range")
+        if idx == len(self) - 1:
+            return len(self._blocks) - 1, len(self._blocks[-1]) - 1
+        return self._locate(idx)
+
+    def _predecessor(self, block_idx, offset):
+        if offset > (self._head if block_idx == 0 else 0):
+            return block_idx, offset - 1
+        return block_idx - 1, len(self._blocks[block_idx - 1]) - 1
+
+    def _leg_masks(self, block_idx, offset):
+        block = self._blocks[block_idx]
+        if offset + 1 < len(block):
+            u, v = block.positions[offset], block.positions[offset + 1]
+        elif block_idx + 1 < len(self._blocks):
+            u, v = block.positions[offset], self._blocks[block_idx + 1].positions[0]
+        else:
+            return 0, 0
+        return self.network.nodes_enroute(u, v), self.network.nodes_between(u, v)
+
+    def _update_leg(self, block_idx, offset):
+        block = self._blocks[block_idx]
+        block.volumes[offset], block.betweens[offset] = self._leg_masks(block_idx, offset)
+        # the old leg masks may have contained nodes the new ones do not, so recompute the whole block
+        block.update(self._head if block_idx == 0 else 0)
+        return block.volumes[offset]
+
+    def _split_block(self, block_idx):
+        block = self._blocks[block_idx]
+        if block_idx == 0 and self._head > 0:
+            # get rid of the served stops first
+            for column in block.columns():
+                del column[:self._head]
+            self._head = 0
+        half = len(block) // 2
+        self._blocks[block_idx:block_idx + 1] = [_StopBlock(*(column[:half] for column in block.columns())),
+                                                 _StopBlock(*(column[half:] for column in block.columns()))]
 
 
 class ZeroDetourBus(object):
     """
     A simulator that simulates a single bus with no-detour policy.
     Any network can be chosen.
+
+    position_engine selects how the leg of the stoplist a new stop is inserted into is found:
+    'index' (default) looks it up in the block index of the Stoplist, 'loop' is the reference
+    scan calling _is_between on every leg, and 'vectorized' evaluates all legs at once on the
+    distance matrix (see Network.first_leg_between).
     """
 
-    def __init__(self, network, req_gen, network_type, initpos=None):
+    def __init__(self, network, req_gen, network_type, initpos=None, position_engine="index"):
         self.network_type = network_type
-        self.network: Network = Network(network,
-                                        network_type=self.network_type, shortest_path_mode=network.shortest_path_mode)
+        self.network: Network = make_network(network,
+                                             network_type=self.network_type,
+                                             shortest_path_mode=network.shortest_path_mode)
         self.req_gen = req_gen
         self.initpos = initpos
 
-        self.position = self.initpos
+        # internally, the bus only deals with integer node ids, see Network.node_index
+        self.position = self.network.node_index[initpos] if initpos is not None else None
         self.time = 0
         self.remaining_time = 0
         self.next_stop = None
 
-        self.stoplist: List[Stop] = []
+        self.stoplist = Stoplist(self.network)
+
+        position_engines = dict(index=self._first_leg_by_index,
+                                loop=self._first_leg_by_loop,
+                                vectorized=self._first_leg_vectorized)
+        if position_engine not in position_engines:
+            raise ValueError(f"Unknown position_engine \"{position_engine}\". "
+                             f"Choose one of {list(position_engines)}.")
+        self.position_engine = position_engine
+        self._first_leg_through = position_engines[position_engine]
 
         # req_data contains for each request:
         # req_epoch, origin, destination, pickup_epoch, dropoff-epoch
-        self.req_data = dict()
+        # stored in columns with node ids, but accessible like a dict of dicts, see ReqData
+        self.req_data = ReqData(self.network.nodes)
 
         # insertion_data contains for each insertion
         # time, stoplist_length, stoplist_volume, rest_stoplist_volume,
@@ -191,7 +862,23 @@ class ZeroDetourBus(object):
         self.insertion_data_columns = ('time', 'stoplist_length', 'stoplist_volume',
                                        'rest_stoplist_volume',
                                        'pickup_index', 'dropoff_index', 'insertion_type')
-        self.insertion_data = []
+        self.insertion_data = InsertionData()
+        # number of warm-up requests preceding this run if it was started from a snapshot
+        self.warmup_num_reqs = 0
+        # the steady-state estimate if simulated with early stopping, see simulate_all_requests
+        self.steady_state = None
+
+        # the driven route: node ids and times of all stops served so far, in order
+        self.route_nodes = array('i')
+        self.route_times = array('d')
+
+        self.num_processed_reqs = 0
+        self.last_req_epoch = 0
+        # what has been flushed to a ChunkedResultSink, see flush_to_sink
+        self.last_flushed_req_id = None
+        self.num_flushed_chunks = 0
+        # the state of the SteadyStateMonitor if restored from a checkpoint, see simulate_all_requests
+        self.steady_state_checkpoint = None
 
     def process_new_request(self, req: Request):
         """
@@ -199,15 +886,7 @@ class ZeroDetourBus(object):
         to request epoch and serve all requests pending until that time.
         """
         # process all requests till now and advance clock
-        # if all stops had already been processed (potentially in last round), but the bus is still moving to its next
-        # stop, i.e. in the middle of an edge
-        if req.req_epoch < self.time:
-            # We are still "in the middle of an edge". There can't be any need to process stops.
-            assert (self.time - req.req_epoch) <= 1
-            self.remaining_time = req.req_epoch - self.time
-        else:
-            # else, fast-forward all remaining stops
-            self.fast_forward(req.req_epoch)
+        self.advance(req.req_epoch)
 
         # then add a dummy-stop (type == -1) at current position
         self._insert_stop_into_stoplist(0, self.position, arrtime=self.time, stop_type=-1, req_id=None)
@@ -216,8 +895,63 @@ class ZeroDetourBus(object):
         self.add_request(req)
 
         # remove dummy stop again
-        dummy_stop = self.stoplist.pop(0)
-        assert dummy_stop.stop_type == -1
+        assert self.stoplist.stop_type_at(0) == -1
+        self.stoplist.drop_head(1)
+
+        self.num_processed_reqs += 1
+        self.last_req_epoch = req.req_epoch
+
+    def advance(self, t):
+        """
+        Advance the internal clock to t, serving all stops pending until then.
+        Advancing again to the same t does not change the state.
+        """
+        # if all stops had already been processed (potentially in last round), but the bus is still moving to its next
+        # stop, i.e. in the middle of an edge
+        if t < self.time:
+            # We are still "in the middle of an edge". There can't be any need to process stops.
+            assert (self.time - t) <= 1
+            self.remaining_time = t - self.time
+        else:
+            # else, fast-forward all remaining stops
+            self.fast_forward(t)
+
+    def route_volume(self) -> int:
+        """
+        Bitmask of the nodes on the route still ahead of the bus: the scheduled route from its
+        current position through all stops.
+        """
+        if not len(self.stoplist):
+            return 0
+        return self.network.nodes_enroute(self.position, self.stoplist.position_at(0)) | self.stoplist.volume()
+
+    def route_cover(self) -> int:
+        """
+        Bitmask of all nodes on any shortest path from the current position through all stops. Contains
+        the route_volume at any later time until the bus gets another request, as the bus only
+        drives along shortest paths between its stops. Used by ZeroDetourFleet to index the vehicles.
+        """
+        if not len(self.stoplist):
+            return 0
+        return self.network.nodes_between(self.position, self.stoplist.position_at(0)) | self.stoplist.between()
+
+    def pickup_epoch(self, origin):
+        """
+        The epoch at which the bus would pick up a request from the node id origin, as add_request
+        would schedule it: without detour if origin is on the scheduled route, else after the last stop.
+        Call after advancing the bus to the request epoch.
+        """
+        if not len(self.stoplist):
+            return self.time + self.network.shortest_path_length(self.position, origin)
+        if not self.route_volume() >> origin & 1:
+            return self.stoplist.time_at(-1) + self.network.shortest_path_length(self.stoplist.position_at(-1),
+                                                                                  origin)
+        self._insert_stop_into_stoplist(0, self.position, arrtime=self.time, stop_type=-1, req_id=None)
+        leg_idx = self._first_leg_through(origin, 0)
+        pickup_epoch = self.stoplist.time_at(leg_idx) + self.network.shortest_path_length(
+            self.stoplist.position_at(leg_idx), origin)
+        self.stoplist.drop_head(1)
+        return pickup_epoch
 
     def fast_forward(self, t):
         """
@@ -226,17 +960,11 @@ class ZeroDetourBus(object):
         """
         self.remaining_time = 0
 
-        for idx, s in enumerate(self.stoplist):
-            self.next_stop = s
-            if s.time <= t:
-                self.process_stop(s)
-            else:
-                self.stoplist = self.stoplist[idx:]
-                self.next_stop = self.stoplist[0]
-                break
-        else:
-            self.stoplist = []
-            self.next_stop = None
+        num_served = self.stoplist.count_until(t)
+        for idx in range(num_served):
+            self.process_stop(idx)
+        self.stoplist.drop_head(num_served)
+        self.next_stop = self.stoplist[0] if len(self.stoplist) else None
 
         # if stoplist is not empty after processing all stops until t do the following
         if self.next_stop:  # we are *not* idling
@@ -253,51 +981,38 @@ class ZeroDetourBus(object):
         Inserts req to self.stoplist
         Logs details of the request and the insertion.
         """
-        assert self.stoplist[0].stop_type == -1
-
-        def position_stop_in_stoplist(requested_stop_position, stoplist):
-            """
-            returns the position of the stop in a stoplist - potentially also just a section of it
-            """
-            for idx_stoplist, (u, v) in enumerate(pairwise(stoplist)):
-                stop_is_on_route, dist_to = self._is_between(requested_stop_position, u.position, v.position)
-                if stop_is_on_route:
-                    break
-            else:
-                # this should never happen
-                raise ValueError(f"Stop {requested_stop_position} is not on the route between any two stops in "
-                                 f"the stoplist. But this should not be possible.")
-
-            return idx_stoplist + 1, u.time + dist_to
+        assert self.stoplist.stop_type_at(0) == -1
+        origin = self.network.node_index[req.origin]
+        destination = self.network.node_index[req.destination]
 
         # we need these numbers only for our statistics
-        nodes_in_stoplist_volume = self.network.all_reachable_nodes_on_stoplist(self.stoplist)
-        len_stoplist_volume = len(nodes_in_stoplist_volume)
+        stoplist_volume = self.stoplist.volume()
+        len_stoplist_volume = popcount(stoplist_volume)
 
-        pickup_enroute = req.origin in nodes_in_stoplist_volume
+        pickup_enroute = stoplist_volume >> origin & 1
         # insert PU
         if pickup_enroute:
-            pickup_idx, pickup_epoch = position_stop_in_stoplist(req.origin, self.stoplist)
+            pickup_idx, pickup_epoch = self._position_stop_in_stoplist(origin)
         else:
             pickup_idx = len(self.stoplist)
-            pickup_epoch = self.stoplist[-1].time + self.network.shortest_path_length(self.stoplist[-1].position,
-                                                                                      req.origin)
-        self._insert_stop_into_stoplist(pickup_idx, req.origin, arrtime=pickup_epoch, stop_type=1, req_id=req.req_id)
+            pickup_epoch = self.stoplist.time_at(-1) + self.network.shortest_path_length(
+                self.stoplist.position_at(-1), origin)
+        self._insert_stop_into_stoplist(pickup_idx, origin, arrtime=pickup_epoch, stop_type=1, req_id=req.req_id)
 
         # again statistics
-        nodes_in_rest_stoplist_volume = self.network.all_reachable_nodes_on_stoplist(self.stoplist[pickup_idx:])
-        len_rest_stoplist_volume = len(nodes_in_rest_stoplist_volume)
+        rest_stoplist_volume = self.stoplist.volume(start=pickup_idx)
+        len_rest_stoplist_volume = popcount(rest_stoplist_volume)
 
-        dropoff_enroute = req.destination in nodes_in_rest_stoplist_volume
+        dropoff_enroute = rest_stoplist_volume >> destination & 1
         if dropoff_enroute:
-            dropoff_idx, dropoff_epoch = position_stop_in_stoplist(req.destination, self.stoplist[pickup_idx:])
+            dropoff_idx, dropoff_epoch = self._position_stop_in_stoplist(destination, start=pickup_idx)
         else:
             dropoff_idx = len(self.stoplist)
-            dropoff_epoch = self.stoplist[-1].time + self.network.shortest_path_length(self.stoplist[-1].position,
-                                                                                       req.destination)
+            dropoff_epoch = self.stoplist.time_at(-1) + self.network.shortest_path_length(
+                self.stoplist.position_at(-1), destination)
 
         # insert DO
-        self._insert_stop_into_stoplist(dropoff_idx + pickup_idx, req.destination, arrtime=dropoff_epoch,
+        self._insert_stop_into_stoplist(dropoff_idx + pickup_idx, destination, arrtime=dropoff_epoch,
                                         stop_type=0, req_id=req.req_id)
 
         # and once more statistics
@@ -307,35 +1022,234 @@ class ZeroDetourBus(object):
         # but first correct for the dummy stop
         pickup_idx -= 1
         dropoff_idx -= 1
-        self.insertion_data.append((self.time, len(self.stoplist) - 2, len_stoplist_volume, len_rest_stoplist_volume,
-                                    pickup_idx, dropoff_idx, request_handling_type))
+        self.insertion_data.append(self.time, len(self.stoplist) - 2, len_stoplist_volume, len_rest_stoplist_volume,
+                                   pickup_idx, dropoff_idx, request_handling_type)
 
         # store self.req_data
-        self.req_data[req.req_id] = dict(origin=req.origin,
-                                         destination=req.destination,
-                                         req_epoch=req.req_epoch,  # NOT self.time
-                                         # since jump. see function fast_forward
-                                         pickup_epoch=pickup_epoch,
-                                         dropoff_epoch=dropoff_epoch)
+        self.req_data.append(req.req_id, origin, destination,
+                             req.req_epoch,  # NOT self.time
+                             # since jump. see function fast_forward
+                             pickup_epoch, dropoff_epoch)
 
-    def simulate_all_requests(self):
+    def _position_stop_in_stoplist(self, requested_stop_position, start=0):
+        """
+        returns the position of the stop in the stoplist from index start on, relative to start
+        """
+        leg_idx = self._first_leg_through(requested_stop_position, start)
+        if leg_idx is None:
+            # this should never happen
+            raise ValueError(f"Stop {requested_stop_position} is not on the route between any two stops in "
+                             f"the stoplist. But this should not be possible.")
+
+        return leg_idx - start + 1, self.stoplist.time_at(leg_idx) + self.network.shortest_path_length(
+            self.stoplist.position_at(leg_idx), requested_stop_position)
+
+    def instrument(self, profiler):
+        """
+        Lets a SimulationProfiler count the calls and time of the hot path of this bus, and record
+        the histogram 'stoplist_length' of the stoplist lengths the requests are inserted into.
+        Only this bus (and its stoplist and network) is affected. Instrument after restoring a
+        checkpoint, as that replaces the stoplist.
+        """
+        profiler.instrument(self, 'fast_forward')
+        profiler.instrument(self, 'add_request')
+        profiler.instrument(self, '_position_stop_in_stoplist', 'position_stop_in_stoplist')
+        profiler.instrument(self, 'interpolate')
+        profiler.instrument(self.stoplist, 'volume', 'Stoplist.volume')
+        profiler.instrument(self.network, 'node_at_hop', 'Network.node_at_hop')
+
+        add_request = self.add_request
+
+        def add_request_recording_stoplist_length(req):
+            # without the dummy stop
+            profiler.record('stoplist_length', len(self.stoplist) - 1)
+            return add_request(req)
+
+        self.add_request = add_request_recording_stoplist_length
+
+    def simulate_all_requests(self, checkpoint_path=None, checkpoint_every=10 ** 5, steady_state=None, sink=None):
         """
         simulates the system till req_gen is empty
+
+        If a checkpoint_path is given, the full state is saved there every checkpoint_every
+        requests (see save_checkpoint), so a crashed run can be resumed.
+
+        If a ChunkedResultSink is passed as sink, the data collected is flushed to it every
+        sink.chunk_size requests and at the end (see flush_to_sink). Checkpoints are then
+        saved right after the flushes instead of every checkpoint_every requests.
+
+        If a SteadyStateMonitor is passed as steady_state, it is fed the service times and the
+        simulation stops early once it has converged. Its final estimate (including the warm-up
+        cutoff and the precision reached) is stored in self.steady_state. It is saved with the
+        checkpoints and continued when resuming from one.
         """
-        for req in tqdm(self.req_gen, desc="Simulating requests"):
+        if steady_state is not None:
+            if self.steady_state_checkpoint is not None:
+                steady_state.restore_checkpoint(self.steady_state_checkpoint)
+            elif self.num_flushed_chunks:
+                raise ValueError("Cannot resume the steady-state monitor from a checkpoint without it, "
+                                 "the service times flushed to the sink are lost.")
+            else:
+                # e.g. after resuming from a checkpoint without the monitor
+                for service_time in self.req_data.column('dropoff_epoch') - self.req_data.column('req_epoch'):
+                    steady_state.add(service_time)
+
+        for req in tqdm(self.req_gen, desc="Simulating requests", initial=self.num_processed_reqs):
             self.process_new_request(req)
+            if steady_state is not None:
+                steady_state.add(self.req_data.value(req.req_id, 'dropoff_epoch') - req.req_epoch)
+            if sink is not None and self.num_processed_reqs % sink.chunk_size == 0:
+                self.flush_to_sink(sink)
+                if checkpoint_path is not None:
+                    self.save_checkpoint(checkpoint_path, steady_state)
+            elif sink is None and checkpoint_path is not None and self.num_processed_reqs % checkpoint_every == 0:
+                self.save_checkpoint(checkpoint_path, steady_state)
+            if steady_state is not None and steady_state.converged():
+                print(f"steady state reached after {self.num_processed_reqs} requests.")
+                break
+
+        if sink is not None:
+            self.flush_to_sink(sink)
+        if steady_state is not None:
+            self.steady_state = steady_state.estimate()
         print(f"simulation complete. current time {self.time}")
 
-    def process_stop(self, s: Stop):
-        self.time = s.time
+    def flush_to_sink(self, sink):
+        """
+        Writes the req_data of all requests not yet flushed, the insertion_data and the driven route
+        to the sink as one chunk and drops them from memory. The req_data of the requests still on the
+        stoplist is kept, as they are needed to serve them.
+        """
+        req_ids = self.req_data.column('req_id')
+        not_flushed = req_ids > self.last_flushed_req_id if self.last_flushed_req_id is not None else req_ids >= 0
+        sink.write(self.req_data.filter(not_flushed), self.insertion_data,
+                   dict(route_nodes=self.route_nodes, route_times=self.route_times, node_labels=self.network.nodes))
+        if not_flushed.any():
+            self.last_flushed_req_id = int(req_ids[not_flushed].max())
+        self.num_flushed_chunks = sink.num_chunks
+
+        self.req_data = self.req_data.filter(np.isin(req_ids, [stop.req_id for stop in self.stoplist]))
+        self.insertion_data = InsertionData(extra_columns=self.insertion_data.columns[len(InsertionData.COLUMNS):])
+        self.route_nodes = array('i')
+        self.route_times = array('d')
+
+    def get_checkpoint(self, steady_state=None) -> dict:
+        """
+        Returns the full state of the simulation as plain data: the bus, its stoplist, the data
+        collected so far, the state of the global random generators and the position of the request
+        generator (the number of requests processed and the epoch of the last one). The network and
+        the request generator themselves are not included, see restore_checkpoint.
+
+        If the SteadyStateMonitor fed by simulate_all_requests is passed as steady_state, its state
+        is included as well.
+        """
+        return dict(initpos=self.initpos,
+                    position=self.position,
+                    time=self.time,
+                    remaining_time=self.remaining_time,
+                    stoplist=[(stop.position, stop.time, stop.stop_type, stop.req_id) for stop in self.stoplist],
+                    req_data=self.req_data,
+                    insertion_data=self.insertion_data,
+                    route_nodes=self.route_nodes,
+                    route_times=self.route_times,
+                    num_reqs=self.num_processed_reqs,
+                    last_req_epoch=self.last_req_epoch,
+                    last_flushed_req_id=self.last_flushed_req_id,
+                    num_flushed_chunks=self.num_flushed_chunks,
+                    steady_state=None if steady_state is None else steady_state.get_checkpoint(),
+                    random_state=random.getstate(),
+                    np_random_state=np.random.get_state())
+
+    def restore_checkpoint(self, checkpoint: dict, restore_random_state=True):
+        """
+        Restores a state returned by get_checkpoint, including the global random generators
+        unless restore_random_state is False.
+        The bus has to be created on the same network with a request generator that continues
+        after checkpoint['num_reqs'] requests at checkpoint['last_req_epoch'] (see the first_req_idx
+        and start_time arguments of req_generator_uniform).
+        """
+        self.initpos = checkpoint['initpos']
+        self.position = checkpoint['position']
+        self.time = checkpoint['time']
+        self.remaining_time = checkpoint['remaining_time']
+        self.stoplist = Stoplist(self.network)
+        for idx, (position, time, stop_type, req_id) in enumerate(checkpoint['stoplist']):
+            self.stoplist.insert(idx, position, time, stop_type, req_id)
+        self.next_stop = self.stoplist[0] if len(self.stoplist) else None
+        self.req_data = checkpoint['req_data']
+        self.insertion_data = checkpoint['insertion_data']
+        self.route_nodes = array('i', checkpoint['route_nodes'])
+        self.route_times = array('d', checkpoint['route_times'])
+        self.num_processed_reqs = checkpoint['num_reqs']
+        self.last_req_epoch = checkpoint['last_req_epoch']
+        self.last_flushed_req_id = checkpoint['last_flushed_req_id']
+        self.num_flushed_chunks = checkpoint['num_flushed_chunks']
+        self.steady_state_checkpoint = checkpoint.get('steady_state')
+        if restore_random_state:
+            random.setstate(checkpoint['random_state'])
+            np.random.set_state(checkpoint['np_random_state'])
+
+    def snapshot(self) -> dict:
+        """
+        Like get_checkpoint, but meant to warm-start further replications from the current
+        (e.g. steady) state, see from_snapshot. The snapshot is independent of the bus and only
+        keeps the req_data of the requests still on the stoplist, which are needed to serve them.
+        """
+        snapshot = self.get_checkpoint()
+        pending_req_ids = [stop.req_id for stop in self.stoplist]
+        snapshot['req_data'] = self.req_data.filter(np.isin(self.req_data.column('req_id'), pending_req_ids))
+        snapshot['insertion_data'] = InsertionData()
+        snapshot['route_nodes'] = array('i')
+        snapshot['route_times'] = array('d')
+        # the forks write their own results, without the warm-up
+        snapshot['last_flushed_req_id'] = max(pending_req_ids, default=None)
+        snapshot['num_flushed_chunks'] = 0
+        return snapshot
+
+    @classmethod
+    def from_snapshot(cls, network, snapshot: dict, req_gen, network_type, position_engine="index"):
+        """
+        Creates a bus continuing from a snapshot with its own request generator, which should
+        use fresh random streams and continue after snapshot['num_reqs'] requests at
+        snapshot['last_req_epoch']. The global random generators are left untouched.
+
+        All requests with req_id <= bus.warmup_num_reqs belong to the warm-up; the ones
+        still pending at the snapshot are served, but should be left out of the statistics.
+        """
+        bus = cls(network, req_gen, network_type, snapshot['initpos'], position_engine)
+        bus.restore_checkpoint(dict(snapshot,
+                                    req_data=snapshot['req_data'].copy(),
+                                    insertion_data=snapshot['insertion_data'].copy()),
+                               restore_random_state=False)
+        bus.warmup_num_reqs = snapshot['num_reqs']
+        return bus
+
+    def save_checkpoint(self, checkpoint_path, steady_state=None):
+        """
+        Saves get_checkpoint(steady_state) to checkpoint_path. save2pickle writes it next to it first and then
+        moves it, so an interruption never leaves a broken checkpoint behind.
+        """
+        save2pickle(self.get_checkpoint(steady_state), checkpoint_path)
+
+    def process_stop(self, idx):
+        """
+        Serves the stop at index idx of the stoplist. Removing it is left to the caller.
+        """
+        self.time = self.stoplist.time_at(idx)
         self.remaining_time = 0
-        self.position = s.position
+        self.position = self.stoplist.position_at(idx)
+        stop_type, req_id = self.stoplist.stop_type_at(idx), self.stoplist.req_id_at(idx)
 
-        if s.stop_type == 1:
-            assert self.req_data[s.req_id]['pickup_epoch'] == self.time
+        if stop_type == 1:
+            assert self.req_data.value(req_id, 'pickup_epoch') == self.time
         else:
-            assert s.stop_type == 0
-            assert self.req_data[s.req_id]['dropoff_epoch'] == self.time
+            assert stop_type == 0
+            assert self.req_data.value(req_id, 'dropoff_epoch') == self.time
+
+        # a pickup and a dropoff at the same node and time are a single visit of the route
+        if not self.route_nodes or self.route_nodes[-1] != self.position or self.route_times[-1] != self.time:
+            self.route_nodes.append(self.position)
+            self.route_times.append(self.time)
 
     def interpolate(self, current_time, started_from, going_to, started_at):
         """
@@ -351,8 +1265,8 @@ class ZeroDetourBus(object):
             remaining_time = 0
             return pos, remaining_time
 
-        shortest_path = self.network.shortest_path(started_from, going_to, stoplist=self.stoplist)
-        shortest_path_length = len(shortest_path) - 1
+        # the next node is looked up in the path tables, see Network.node_at_hop
+        shortest_path_length = self.network.hops(started_from, going_to)
 
         if current_time >= started_at + shortest_path_length:
             pos = going_to
@@ -361,10 +1275,24 @@ class ZeroDetourBus(object):
             delta_t = current_time - started_at
             num_nodes_traversed = ceil(delta_t)  # next node
             remaining_time = num_nodes_traversed - delta_t
-            pos = shortest_path[num_nodes_traversed]
+            pos = self.network.node_at_hop(started_from, going_to, num_nodes_traversed)
 
         return pos, remaining_time
 
+    def _first_leg_by_index(self, node, start):
+        return self.stoplist.first_leg_through(node, start)
+
+    def _first_leg_by_loop(self, node, start):
+        for leg_idx, (u, v) in enumerate(pairwise(islice(self.stoplist, start, None)), start=start):
+            stop_is_on_route, _ = self._is_between(node, u.position, v.position)
+            if stop_is_on_route:
+                return leg_idx
+        return None
+
+    def _first_leg_vectorized(self, node, start):
+        leg_idx = self.network.first_leg_between(node, self.stoplist.positions(start))
+        return None if leg_idx is None else leg_idx + start
+
     def _is_between(self, a, u, v):
         """
         checks if a is on a shortest path between u and v
@@ -375,11 +1303,187 @@ class ZeroDetourBus(object):
         return is_inbetween, dist_to
 
     def _insert_stop_into_stoplist(self, idx, position, arrtime, stop_type, req_id):
-        stop = Stop(position=position,
-                    time=arrtime,
-                    stop_type=stop_type,
-                    req_id=req_id)
-        self.stoplist.insert(idx, stop)
+        self.stoplist.insert(idx, position=position,
+                             time=arrtime,
+                             stop_type=stop_type,
+                             req_id=req_id)
+
+
+class ZeroDetourFleet(object):
+    """
+    A simulator that simulates a fleet of buses with no-detour policy on the same network.
+    Every request is assigned to one vehicle, which then handles it exactly like a ZeroDetourBus.
+
+    Dispatching: the request goes to the vehicle that picks it up earliest (see
+    ZeroDetourBus.pickup_epoch), ties going to the lowest vehicle index. To keep the dispatch cost
+    low for large fleets, the vehicles are searched in three groups, each in the order of a lower
+    bound of their pickup epoch, and only as long as that bound does not exceed the best pickup
+    epoch found:
+
+    - the busy vehicles whose route ahead may pass the origin: vehicles_at[n] holds the vehicles
+      whose route cover (see ZeroDetourBus.route_cover) contained node id n when they were last
+      advanced or got a request, which contains their route volume at any time until they get the
+      next request. They are advanced and checked. Bound: the time at which they could reach the
+      origin directly.
+    - the idle vehicles (whose stoplist has ended by the request epoch), indexed by the node they
+      wait at in idle_at. Their pickup epoch is the request epoch plus the distance to the origin,
+      so the nodes are searched by increasing distance from the origin.
+    - all other busy vehicles: they pick up after their last stop, so the time their stoplist ends
+      is a lower bound. They are taken from a heap ordered by it.
+
+    If no initposs are given, the initial positions are drawn uniformly from the nodes with
+    np.random.default_rng(seed).
+    """
+
+    def __init__(self, network, req_gen, network_type, num_vehicles, initposs=None, position_engine="index", seed=0):
+        self.network_type = network_type
+        self.network: Network = make_network(network,
+                                             network_type=self.network_type,
+                                             shortest_path_mode=network.shortest_path_mode)
+        self.req_gen = req_gen
+        if initposs is None:
+            initposs = [self.network.nodes[node_id]
+                        for node_id in np.random.default_rng(seed).integers(len(self.network.nodes), size=num_vehicles)]
+        self.vehicles = [ZeroDetourBus(self.network, None, network_type, initpos, position_engine)
+                         for initpos in initposs]
+        if len(self.vehicles) != num_vehicles:
+            raise ValueError(f"Got {len(self.vehicles)} initial positions for {num_vehicles} vehicles.")
+
+        self.vehicles_at = [set() for _ in self.network.nodes]
+        self._indexed_volumes = [0] * num_vehicles
+        # (time the stoplist ends, vehicle) of the busy vehicles - entries are outdated if the end time
+        # has changed since or the vehicle has become idle
+        self._end_times = [0] * num_vehicles
+        self._end_heap = []
+        # the idle vehicles by the node id they wait at
+        self.idle_at = [set() for _ in self.network.nodes]
+        self._idle_position = [None] * num_vehicles
+        self._num_idle = 0
+        for vehicle_idx, vehicle in enumerate(self.vehicles):
+            self._set_idle(vehicle_idx, vehicle.position)
+        # the nodes ids by increasing distance from each node id, to search the idle vehicles
+        self._nodes_by_distance = np.argsort(self.network._dist, axis=1, kind='stable').tolist()
+
+        # req_data and insertion_data as in ZeroDetourBus, but over the whole fleet
+        # req_data additionally contains the vehicle, insertion_data has the vehicle as last entry
+        self.req_data = ReqData(self.network.nodes, extra_columns=[('vehicle', 'i')])
+        self.insertion_data = InsertionData(extra_columns=[('vehicle', 'q')])
+
+    def process_new_request(self, req: Request):
+        """
+        Dispatch a new request to a vehicle and let it process the request.
+        """
+        origin = self.network.node_index[req.origin]
+        req_epoch = req.req_epoch
+        distances_to_origin = self.network._all_shortest_path_lengths[origin]
+
+        # vehicles whose stoplist has ended by now are idle at their last stop
+        while self._end_heap and self._end_heap[0][0] <= req_epoch:
+            end_time, vehicle_idx = heappop(self._end_heap)
+            if end_time == self._end_times[vehicle_idx] and self._idle_position[vehicle_idx] is None:
+                vehicle = self.vehicles[vehicle_idx]
+                self._set_idle(vehicle_idx, vehicle.stoplist.position_at(-1) if len(vehicle.stoplist)
+                               else vehicle.position)
+
+        best = None  # (pickup_epoch, vehicle_idx)
+        evaluated = set()
+
+        def evaluate(candidate_idx):
+            nonlocal best
+            evaluated.add(candidate_idx)
+            candidate = self.vehicles[candidate_idx]
+            candidate.advance(req_epoch)
+            candidate_pickup_epoch = candidate.pickup_epoch(origin)
+            self._update_index(candidate_idx)
+            if best is None or (candidate_pickup_epoch, candidate_idx) < best:
+                best = (candidate_pickup_epoch, candidate_idx)
+
+        # busy vehicles whose route ahead may pass the origin. A vehicle that was at its position at
+        # its time cannot be at the origin any earlier
+        def earliest_possible_pickup(candidate_idx):
+            candidate = self.vehicles[candidate_idx]
+            return max(req_epoch, candidate.time + distances_to_origin[candidate.position])
+
+        for bound, candidate_idx in sorted((earliest_possible_pickup(candidate_idx), candidate_idx)
+                                           for candidate_idx in self.vehicles_at[origin]
+                                           if self._idle_position[candidate_idx] is None):
+            if best is not None and bound > best[0]:
+                break
+            evaluate(candidate_idx)
+
+        # idle vehicles, by increasing distance
+        if self._num_idle:
+            for node in self._nodes_by_distance[origin]:
+                pickup_epoch = req_epoch + distances_to_origin[node]
+                if best is not None and pickup_epoch > best[0]:
+                    break
+                for candidate_idx in self.idle_at[node]:
+                    if best is None or (pickup_epoch, candidate_idx) < best:
+                        best = (pickup_epoch, candidate_idx)
+
+        # all other busy vehicles, by the time their stoplist ends
+        popped = []
+        while self._end_heap and (best is None or self._end_heap[0][0] <= best[0]):
+            end_time, candidate_idx = heappop(self._end_heap)
+            if end_time != self._end_times[candidate_idx] or self._idle_position[candidate_idx] is not None:
+                continue
+            popped.append((end_time, candidate_idx))
+            if candidate_idx not in evaluated:
+                evaluate(candidate_idx)
+        for entry in popped:
+            # evaluating does not change the end times
+            heappush(self._end_heap, entry)
+
+        vehicle_idx = best[1]
+        vehicle = self.vehicles[vehicle_idx]
+        vehicle.process_new_request(req)
+        self._update_index(vehicle_idx)
+
+        self.req_data.append(*vehicle.req_data.row(req.req_id), vehicle_idx)
+        self.insertion_data.append(*vehicle.insertion_data[-1], vehicle_idx)
+
+    def _set_idle(self, vehicle_idx, position):
+        self._idle_position[vehicle_idx] = position
+        self.idle_at[position].add(vehicle_idx)
+        self._num_idle += 1
+
+    def _update_index(self, vehicle_idx):
+        """
+        Updates vehicles_at, idle_at and the end time heap after the vehicle has changed.
+        """
+        vehicle = self.vehicles[vehicle_idx]
+        volume = vehicle.route_cover()
+        changed = volume ^ self._indexed_volumes[vehicle_idx]
+        while changed:
+            node_mask = changed & -changed
+            node = node_mask.bit_length() - 1
+            if volume & node_mask:
+                self.vehicles_at[node].add(vehicle_idx)
+            else:
+                self.vehicles_at[node].discard(vehicle_idx)
+            changed ^= node_mask
+        self._indexed_volumes[vehicle_idx] = volume
+
+        if not len(vehicle.stoplist):
+            return
+        if self._idle_position[vehicle_idx] is not None:
+            # got a request
+            self.idle_at[self._idle_position[vehicle_idx]].discard(vehicle_idx)
+            self._idle_position[vehicle_idx] = None
+            self._num_idle -= 1
+            self._end_times[vehicle_idx] = None
+        end_time = vehicle.stoplist.time_at(-1)
+        if end_time != self._end_times[vehicle_idx]:
+            self._end_times[vehicle_idx] = end_time
+            heappush(self._end_heap, (end_time, vehicle_idx))
+
+    def simulate_all_requests(self):
+        """
+        simulates the system till req_gen is empty
+        """
+        for req in tqdm(self.req_gen, desc=f"Simulating requests for {len(self.vehicles)} vehicles"):
+            self.process_new_request(req)
+        print(f"simulation complete. current time {max(vehicle.time for vehicle in self.vehicles)}")
 
 
 class FixedRouteBus(object):
@@ -548,6 +1652,79 @@ class FixedRouteBus(object):
                 (-1, -1, -1, -1, -1,
                  -1, -1, -1, -1))
 
+    def process_new_requests(self, req_epochs, origins, destinations):
+        """
+        Vectorized version of process_new_request for a whole batch of requests: same arithmetic, but on
+        arrays of request epochs, origins and destinations (for grids, origins and destinations are (k, 2)
+        arrays of node labels). Returns the arrays (pickup_epochs, dropoff_epochs). req_data and
+        insertion_data are not touched.
+        """
+        req_epochs = np.asarray(req_epochs)
+        origins = np.asarray(origins)
+        destinations = np.asarray(destinations)
+        bus_position_at_request = np.mod(req_epochs, self.route_length)
+
+        if self.graph_type == "grid":
+            pickup = origins[:, 0]*np.sqrt(self.N) + origins[:, 1]
+            dropoff = destinations[:, 0]*np.sqrt(self.N) + destinations[:, 1]
+            pickup_epochs = req_epochs + pickup - bus_position_at_request \
+                + np.where(pickup >= bus_position_at_request, 0, self.route_length)
+            dropoff_epochs = pickup_epochs + dropoff - pickup + np.where(dropoff >= pickup, 0, self.route_length)
+
+        elif self.graph_type == "line":
+            origin_position_forward = origins
+            origin_position_backward = self.N - 1 - origins
+            destination_position_forward = destinations
+            destination_position_backward = self.N - 1 - destinations
+
+            forward_at_request = bus_position_at_request < (self.N-1)
+            catches_forward = forward_at_request & (bus_position_at_request <= origin_position_forward)
+            misses_forward = forward_at_request & ~catches_forward
+            catches_backward = ~forward_at_request & (
+                    bus_position_at_request - (self.N-1) <= origin_position_backward)
+            pickup_epochs = np.select(
+                [catches_forward, misses_forward, catches_backward],
+                [req_epochs + origin_position_forward - bus_position_at_request,
+                 req_epochs + origin_position_backward + self.N - 1 - bus_position_at_request,
+                 req_epochs + origin_position_backward - (bus_position_at_request - (self.N-1))],
+                req_epochs + origin_position_forward + self.route_length - bus_position_at_request)
+            # the direction of the bus at pickup
+            forward = catches_forward | ~(forward_at_request | catches_backward)
+
+            dropoff_epochs = np.select(
+                [forward & (origin_position_forward <= destination_position_forward),
+                 forward,
+                 origin_position_backward <= destination_position_backward],
+                [pickup_epochs + destination_position_forward - origin_position_forward,
+                 pickup_epochs + destination_position_backward + self.N - 1 - origin_position_forward,
+                 pickup_epochs + destination_position_backward - origin_position_backward],
+                pickup_epochs + destination_position_forward + self.N - 1 - origin_position_backward)
+
+        elif self.graph_type == "star":
+            from_center = origins == 0
+            pickup_position = np.where(from_center,
+                                       bus_position_at_request + 2 - np.mod(bus_position_at_request, 2),
+                                       2*origins - 1)
+            dropoff_position = 2*destinations - 1
+            pickup_epochs = req_epochs + pickup_position - bus_position_at_request \
+                + np.where(from_center | (pickup_position >= bus_position_at_request), 0, self.route_length)
+            dropoff_epochs = np.where(
+                destinations == 0,
+                pickup_epochs + 1,
+                pickup_epochs + dropoff_position - pickup_position
+                + np.where(dropoff_position > pickup_position, 0, self.route_length))
+
+        elif self.graph_type == "cycle":
+            pickup_epochs = req_epochs + origins - bus_position_at_request \
+                + np.where(origins >= bus_position_at_request, 0, self.route_length)
+            dropoff_epochs = pickup_epochs + destinations - origins \
+                + np.where(destinations >= origins, 0, self.route_length)
+
+        else:
+            raise ValueError(f"No fixed route defined for topology {self.graph_type}")
+
+        return pickup_epochs, dropoff_epochs
+
     def simulate_all_requests(self):
         for req in self.req_gen:
             self.process_new_request(req)
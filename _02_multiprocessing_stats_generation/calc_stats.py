@@ -1,10 +1,11 @@
 import bisect
+from array import array
 
 import numpy as np
 
-from rolling_mean_servicetime import rolling_mean_servicetime
-from stoplists_and_route_lengths import stoplists_and_node_visit_frequencies_optimized
-from utils import run_or_get_pickle, pickle_loader, tscpt_by_topo
+from rolling_mean_servicetime import rolling_mean_servicetime, rolling_mean
+from stoplists_and_route_lengths import stoplists_and_node_visit_frequencies_optimized, stoplist_lengths_from_route
+from utils import run_or_get_pickle, pickle_loader, tscpt_by_topo, iter_result_chunks
 
 
 def calc_single_stats(x, topology, mode, chunk_size):
@@ -15,14 +16,95 @@ def calc_single_stats(x, topology, mode, chunk_size):
         print(f"Got exception trying to load {PICKLE_FILE}.")
         raise e
 
-    req_data = result[0]
-    insertion_data = result[1]
+    if result[0] is None:
+        # written in chunks while simulating, see ChunkedResultSink
+        print(f"Simulation data for x = {x}. found in chunks. Calculating statistics.")
+        return calc_single_stats_over_chunks(x, iter_result_chunks(result[2]['chunk_dir']), chunk_size)
     print(f"Simulation data for x = {x}. loaded. Calculating statistics.")
+    # newer simulations emit the driven route directly, see ZeroDetourBus.route_nodes
+    if len(result) > 2 and 'route_nodes' in result[2]:
+        return calc_single_stats_over_chunks(x, [result], chunk_size)
+    return calc_single_stats_replayed(x, result[0], result[1], chunk_size)
+
+
+def calc_single_stats_over_chunks(x, chunks, chunk_size):
+    """
+    Computes the statistics of a simulation that emitted the driven route chunk by chunk, so that only
+    the service times and the route are kept over all chunks. chunks is an iterable of
+    (req_data, insertion_data, extras) as written by a ChunkedResultSink, or a single result of
+    simulate_single_request_rate.
+    """
+    insertion_columns = ("stoplist_length", "stoplist_volume", "rest_stoplist_volume")
+    insertion_sums = dict.fromkeys(insertion_columns, 0)
+    num_insertions = 0
+    service_times = []
+    unique_scheduled_stops_sum = 0
+    route_nodes, route_times = array('i'), array('d')
+    # the resulting route_lengths at each stop, see calc_single_stats_replayed
+    current_route_lengths = []
+    # the stoplist at the end of the previous chunk
+    scheduled, stoplist_length = (), 0
+
+    for req_data, insertion_data, extras in chunks:
+        for column in insertion_columns:
+            insertion_sums[column] += int(insertion_data.column(column).sum())
+        num_insertions += len(insertion_data)
+        req_epochs = req_data.column('req_epoch')
+        service_times.append(req_data.column('dropoff_epoch') - req_epochs)
+
+        stoplist_lengths_over_reqs, unique_scheduled_stops_over_reqs, scheduled = stoplist_lengths_from_route(
+            req_data, extras['route_times'], scheduled)
+        unique_scheduled_stops_sum += int(unique_scheduled_stops_over_reqs.sum())
+        # the stops of a chunk are served after the last request of the previous one
+        for visit in extras['route_times']:
+            index = bisect.bisect_right(req_epochs, visit)
+            current_route_lengths.append(stoplist_lengths_over_reqs[index - 1] if index > 0 else stoplist_length)
+        if len(stoplist_lengths_over_reqs):
+            stoplist_length = stoplist_lengths_over_reqs[-1]
+
+        node_labels = extras['node_labels']
+        route_nodes.extend(extras['route_nodes'])
+        route_times.extend(extras['route_times'])
+
+    service_times = np.concatenate(service_times)
+    x_stats = {
+        "n_arr": insertion_sums["stoplist_length"] / num_insertions,
+        "route_vol_arr": insertion_sums["stoplist_volume"] / num_insertions,
+        "rest_route_vol_arr": insertion_sums["rest_stoplist_volume"] / num_insertions
+    }
+    x_stats["s_t_arr_25"], x_stats["s_t_arr_50"], x_stats["s_t_arr_75"] = np.percentile(service_times, (25, 50, 75))
+    x_stats["s_t_arr_mean"] = np.mean(service_times)
+    x_stats["s_t_arr_std"] = np.std(service_times)
+    x_stats["mean_unique_stoplist_length"] = unique_scheduled_stops_sum / len(service_times)
+
+    node_visits_dict = {}
+    for node, visit in zip(route_nodes, route_times):
+        node_visits_dict.setdefault(node_labels[node], []).append(visit)
+    x_stats.update(node_visit_frequency_stats(node_visits_dict))
+
+    route = tuple(node_labels[node] for node in route_nodes)
+
+    print(f"Calculating 3D-statistics for x = {x}.")
+    rollingmeanservicetime = rolling_mean(service_times, chunk_size)
+
+    return route, current_route_lengths, x_stats, rollingmeanservicetime
 
+
+def calc_single_stats_replayed(x, req_data, insertion_data, chunk_size):
+    """
+    Computes the statistics of an older simulation without the driven route by replaying its
+    requests, see stoplists_and_node_visit_frequencies_optimized.
+    """
     # Compute statistics for insertion_data
-    stoplist_lens = [item[1] for item in insertion_data]
-    stoplist_volumes = [item[2] for item in insertion_data]
-    rest_stoplist_volumes = [item[3] for item in insertion_data]
+    if hasattr(insertion_data, "column"):
+        # columnar insertion_data, see utils.InsertionData
+        stoplist_lens = insertion_data.column("stoplist_length")
+        stoplist_volumes = insertion_data.column("stoplist_volume")
+        rest_stoplist_volumes = insertion_data.column("rest_stoplist_volume")
+    else:
+        stoplist_lens = [item[1] for item in insertion_data]
+        stoplist_volumes = [item[2] for item in insertion_data]
+        rest_stoplist_volumes = [item[3] for item in insertion_data]
 
     x_stats = {
         "n_arr": np.mean(stoplist_lens),
@@ -31,7 +113,11 @@ def calc_single_stats(x, topology, mode, chunk_size):
     }
     # tscpt_by_topology = tscpt_by_topo(topology)
     # Compute statistics for req_data
-    service_times = [item['dropoff_epoch'] - item['req_epoch'] for item in req_data.values()]
+    if hasattr(req_data, "column"):
+        # columnar req_data, see utils.ReqData
+        service_times = req_data.column('dropoff_epoch') - req_data.column('req_epoch')
+    else:
+        service_times = [item['dropoff_epoch'] - item['req_epoch'] for item in req_data.values()]
     x_stats["s_t_arr_25"], x_stats["s_t_arr_50"], x_stats["s_t_arr_75"] = np.percentile(service_times, (25, 50, 75))
     x_stats["s_t_arr_mean"] = np.mean(service_times)
     x_stats["s_t_arr_std"] = np.std(service_times)
@@ -44,23 +130,7 @@ def calc_single_stats(x, topology, mode, chunk_size):
         req_data)
 
     x_stats["mean_unique_stoplist_length"] = np.mean(unique_scheduled_stops_over_reqs)
-
-    # compute [mean, SD] of delta t between visits for each node at request rate x
-    node_visits_delta = {node: np.subtract(visits[1:], visits[:-1]) for node, visits in node_visits_dict.items()}
-    node_visit_frequency = {k: [np.power(np.mean(v[1:]), -1), np.power(np.std(v[1:]), -1)] for k, v in
-                            node_visits_delta.items()}
-
-    # calculating the mean and SD for all nodes of the mean of frequency of visits of each node at request rate x
-    node_visit_frequency_means = [i[0] for i in node_visit_frequency.values()]
-    node_visit_frequency_sds = [i[1] for i in node_visit_frequency.values()]
-
-    (x_stats["node_visit_frequency_arr_25"], x_stats["node_visit_frequency_arr_50"],
-     x_stats["node_visit_frequency_arr_75"]) = np.percentile(node_visit_frequency_means, (25, 50, 75))
-    x_stats["node_visit_frequency_arr_mean"] = np.mean(node_visit_frequency_means)
-    x_stats["node_visit_frequency_arr_std"] = np.std(node_visit_frequency_means)
-
-    x_stats["node_visit_frequency_arr_mean_of_individual_stds"] = np.mean(node_visit_frequency_sds)
-    x_stats["node_visit_frequency_arr_std_of_individual_stds"] = np.std(node_visit_frequency_sds)
+    x_stats.update(node_visit_frequency_stats(node_visits_dict))
 
     # create the route driven and the visit times.
     visit_list = [(node, visit) for node, visits in node_visits_dict.items() for visit in visits]
@@ -70,7 +140,8 @@ def calc_single_stats(x, topology, mode, chunk_size):
     # resulting route_lengths - evaluated at each stop as opposed to at each request
     # (this drastically shortens the array since we usually have much more requests than stops)
     current_route_lengths = []
-    req_epochs = [item["req_epoch"] for item in req_data.values()]
+    req_epochs = req_data.column("req_epoch") if hasattr(req_data, "column") else [item["req_epoch"] for item in
+                                                                                   req_data.values()]
 
     for visit in visits:
         index = bisect.bisect_right(req_epochs, visit)
@@ -85,6 +156,27 @@ def calc_single_stats(x, topology, mode, chunk_size):
     return route, current_route_lengths, x_stats, rollingmeanservicetime
 
 
+def node_visit_frequency_stats(node_visits_dict):
+    x_stats = {}
+    # compute [mean, SD] of delta t between visits for each node at request rate x
+    node_visits_delta = {node: np.subtract(visits[1:], visits[:-1]) for node, visits in node_visits_dict.items()}
+    node_visit_frequency = {k: [np.power(np.mean(v[1:]), -1), np.power(np.std(v[1:]), -1)] for k, v in
+                            node_visits_delta.items()}
+
+    # calculating the mean and SD for all nodes of the mean of frequency of visits of each node at request rate x
+    node_visit_frequency_means = [i[0] for i in node_visit_frequency.values()]
+    node_visit_frequency_sds = [i[1] for i in node_visit_frequency.values()]
+
+    (x_stats["node_visit_frequency_arr_25"], x_stats["node_visit_frequency_arr_50"],
+     x_stats["node_visit_frequency_arr_75"]) = np.percentile(node_visit_frequency_means, (25, 50, 75))
+    x_stats["node_visit_frequency_arr_mean"] = np.mean(node_visit_frequency_means)
+    x_stats["node_visit_frequency_arr_std"] = np.std(node_visit_frequency_means)
+
+    x_stats["node_visit_frequency_arr_mean_of_individual_stds"] = np.mean(node_visit_frequency_sds)
+    x_stats["node_visit_frequency_arr_std_of_individual_stds"] = np.std(node_visit_frequency_sds)
+    return x_stats
+
+
 def calc_single_stats_wrapped(x, topology, spm, chunk_size):
     unique_id = f'{topology}_{spm}_{str(x)}'
     wrapped_function = run_or_get_pickle(unique_id, "02_stats")(calc_single_stats)
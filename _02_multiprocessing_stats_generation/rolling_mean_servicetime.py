@@ -2,16 +2,25 @@ import numpy as np
 
 
 def rolling_mean_servicetime(req_data_dict, chunk_size):
-    
-    n = 10 ** 3
 
     # Create NumPy arrays for 'dropoff_epoch' and 'req_epoch' for all records
-    dropoff_epochs = np.array([record_data["dropoff_epoch"] for record_data in req_data_dict.values()])
-    req_epochs = np.array([record_data["req_epoch"] for record_data in req_data_dict.values()])
+    if hasattr(req_data_dict, "column"):
+        # columnar req_data, see utils.ReqData
+        dropoff_epochs = req_data_dict.column("dropoff_epoch")
+        req_epochs = req_data_dict.column("req_epoch")
+    else:
+        dropoff_epochs = np.array([record_data["dropoff_epoch"] for record_data in req_data_dict.values()])
+        req_epochs = np.array([record_data["req_epoch"] for record_data in req_data_dict.values()])
 
     # Compute 'service_time' for all records
     service_times = dropoff_epochs - req_epochs
 
+    return rolling_mean(service_times, chunk_size)
+
+
+def rolling_mean(service_times, chunk_size):
+    n = 10 ** 3
+
     # Calculate the rolling mean of the downsampled data
     rm_st = np.convolve(service_times, np.ones(chunk_size) / chunk_size, mode='valid')
 
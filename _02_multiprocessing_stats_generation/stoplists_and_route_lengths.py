@@ -1,3 +1,6 @@
+import numpy as np
+
+
 def stoplists_and_node_visit_frequencies(req_df):
     node_visits_dict = {}
     # to decrease computational complexity, we build an auxiliary visitlist that only contains visit-times
@@ -74,3 +77,51 @@ def stoplists_and_node_visit_frequencies_optimized(req_data):
     return node_visits_dict, routelistlength_over_reqs, unique_scheduled_stops_over_reqs
 
 
+
+
+def stoplist_lengths_from_route(req_data, route_times, scheduled=()):
+    """
+    Derives the stoplist lengths over requests of stoplists_and_node_visit_frequencies_optimized
+    from the driven route (see ZeroDetourBus.route_times) instead of replaying all requests: a visit
+    is on the stoplist from the first request picked up or dropped off at it until the last request
+    before it. The visits still scheduled after the route are taken from the pickup and dropoff
+    epochs and from scheduled.
+
+    scheduled are the times of the visits scheduled before the first request in req_data, e.g. by
+    the previous chunk of a ChunkedResultSink. They, and the visits of the route without any request
+    in req_data (e.g. from a warm-up), count from the first request on.
+
+    Returns the stoplist lengths and the numbers of unique scheduled stops over the requests, and the
+    times of the visits still scheduled after the last request, to be passed on to the next chunk.
+    """
+    req_epochs = req_data.column('req_epoch')
+    num_reqs = len(req_epochs)
+    event_epochs = np.concatenate((req_data.column('pickup_epoch'), req_data.column('dropoff_epoch')))
+    event_reqs = np.tile(np.arange(num_reqs), 2)
+    order = np.lexsort((event_reqs, event_epochs))
+    event_epochs, event_reqs = event_epochs[order], event_reqs[order]
+    scheduled = np.asarray(scheduled, dtype=float)
+
+    visit_times = np.asarray(route_times, dtype=float)
+    last_visit = visit_times[-1] if len(visit_times) else -np.inf
+    visit_times = np.concatenate((visit_times, np.union1d(event_epochs[event_epochs > last_visit],
+                                                          scheduled[scheduled > last_visit])))
+    if not num_reqs:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), visit_times
+
+    # the bus is at a single node at any time, so the first event at the time of a visit is the
+    # first request served by it
+    first_event = np.minimum(np.searchsorted(event_epochs, visit_times), len(event_epochs) - 1)
+    found = (event_epochs[first_event] == visit_times) & ~np.isin(visit_times, scheduled)
+    scheduled_by = np.where(found, event_reqs[first_event], 0)
+
+    def count_scheduled(times, scheduled_by):
+        until = np.searchsorted(req_epochs, times)
+        valid = scheduled_by < until
+        return np.cumsum(np.bincount(scheduled_by[valid], minlength=num_reqs + 1)
+                         - np.bincount(until[valid], minlength=num_reqs + 1))[:num_reqs]
+
+    unique = np.flatnonzero(np.diff(visit_times, prepend=-np.inf) > 0)
+    return (count_scheduled(visit_times, scheduled_by),
+            count_scheduled(visit_times[unique], np.minimum.reduceat(scheduled_by, unique)),
+            visit_times[visit_times > req_epochs[-1]])
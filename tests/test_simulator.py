@@ -0,0 +1,32 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, '_01_multiprocessing_data_generation'))
+
+from req_generator import req_generator_chunked
+from simulator import ZeroDetourFleet, make_network
+from utils import graph_constructor
+
+
+def test_fleet_without_initial_positions():
+    G = graph_constructor('grid_9')
+    network = make_network(G, 'grid_9', 'staticmax')
+    fleet = ZeroDetourFleet(network, req_generator_chunked(G, 50, 1.0, seed=1), 'grid_9', num_vehicles=4)
+    assert all(vehicle.initpos in network.node_index for vehicle in fleet.vehicles)
+
+    fleet.simulate_all_requests()
+    assert len(fleet.req_data) == 50
+    assert set(fleet.req_data.column('vehicle')) <= set(range(4))
+
+
+def test_novolcomp_copy_has_no_volumes():
+    for topology in ('grid_9', 'cycle_10'):
+        G = graph_constructor(topology)
+        network = make_network(G, topology, 'all_volume_info')
+        assert any(network.nodes_enroute(u, v) for u in range(len(network.nodes)) for v in range(len(network.nodes)))
+
+        copy = make_network(network, 'novolcomp', 'all_volume_info')
+        assert all(copy.nodes_enroute(u, v) == 0 for u in range(len(copy.nodes)) for v in range(len(copy.nodes)))
+        assert make_network(copy, topology, 'all_volume_info')._volume_masks == network._volume_masks
@@ -1,8 +1,13 @@
 from .pickle_save_and_load import save2pickle, pickle_loader, run_or_get_pickle
 from .volume_maximizing_shortest_path import get_shortest_paths_and_volume
 from .stats_dict import get_stats_dict
-from .env_params import topologies, shortest_path_modes, xrange, numreqs, casestudy_params, graphics_dir
+from .env_params import topologies, shortest_path_modes, xrange, numreqs, crn_seed, casestudy_params, \
+    graphics_dir
 from .tolopogy_constructor import graph_constructor
 from .plotting_styles import topo_color, n_marker
-from .get_x_from_filenames import get_all_x
+from .get_x_from_filenames import get_all_x, simulation_mode
 from .tscpt import tscpt_by_topo
+from .steady_state import SteadyStateMonitor
+from .columnar_data import ReqData, InsertionData
+from .result_sink import ChunkedResultSink, iter_result_chunks, load_chunked_result
+from .profiling import SimulationProfiler
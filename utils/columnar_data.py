@@ -0,0 +1,180 @@
+from array import array
+from bisect import bisect_right
+
+import numpy as np
+
+
+class _ColumnarData(object):
+    """
+    Simulation output stored as one growable array.array per column instead of one python object
+    per row. Subclasses define the COLUMNS as (name, typecode) pairs, extra_columns are appended.
+    """
+    COLUMNS = ()
+
+    def __init__(self, extra_columns=()):
+        self.columns = tuple(self.COLUMNS) + tuple(extra_columns)
+        self._data = [array(typecode) for _, typecode in self.columns]
+        self._column_index = {name: idx for idx, (name, _) in enumerate(self.columns)}
+
+    def __len__(self):
+        return len(self._data[0])
+
+    def column(self, name) -> np.ndarray:
+        """
+        Returns a copy of the column as numpy array, e.g. for vectorized statistics.
+        """
+        return np.array(self._data[self._column_index[name]])
+
+    def _append(self, values):
+        for column, value in zip(self._data, values, strict=True):
+            column.append(value)
+
+    def _row(self, row) -> tuple:
+        return tuple(column[row] for column in self._data)
+
+    def filter(self, mask):
+        """
+        Returns a new object containing only the rows where the boolean array mask is True.
+        """
+        filtered = self.copy()
+        filtered._data = [array(column.typecode, np.array(column)[mask].tolist()) for column in self._data]
+        return filtered
+
+    def extend(self, other):
+        """
+        Appends all rows of other, which has to have the same columns.
+        """
+        for column, other_column in zip(self._data, other._data, strict=True):
+            column.extend(other_column)
+
+    def copy(self):
+        copied = object.__new__(type(self))
+        copied.__dict__.update(self.__dict__)
+        copied._data = [array(column.typecode, column) for column in self._data]
+        return copied
+
+
+class InsertionData(_ColumnarData):
+    """
+    The insertion data of a ZeroDetourBus. Behaves like the list of tuples
+    (time, stoplist_length, stoplist_volume, rest_stoplist_volume, pickup_index, dropoff_index,
+    insertion_type) it replaces: indexing and iterating yield these tuples.
+    """
+    COLUMNS = (('time', 'd'), ('stoplist_length', 'q'), ('stoplist_volume', 'q'), ('rest_stoplist_volume', 'q'),
+               ('pickup_index', 'q'), ('dropoff_index', 'q'), ('insertion_type', 'q'))
+
+    def append(self, *values):
+        self._append(values)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._row(row) for row in range(*idx.indices(len(self)))]
+        return self._row(idx)
+
+    def __iter__(self):
+        return zip(*self._data)
+
+    def __eq__(self, other):
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+
+class ReqData(_ColumnarData):
+    """
+    The request data of a ZeroDetourBus, with the origins and destinations stored as integer node ids.
+    Behaves like the dict {req_id: dict(origin, destination, req_epoch, pickup_epoch, dropoff_epoch)}
+    it replaces, translating the node ids back to the node_labels. Rows are only appended, as all
+    epochs of a request are known once it is inserted.
+    """
+    COLUMNS = (('req_id', 'q'), ('origin', 'i'), ('destination', 'i'),
+               ('req_epoch', 'd'), ('pickup_epoch', 'd'), ('dropoff_epoch', 'd'))
+    NODE_COLUMNS = ('origin', 'destination')
+
+    def __init__(self, node_labels, extra_columns=()):
+        super().__init__(extra_columns)
+        self.node_labels = node_labels
+        # runs of consecutive req_ids: the first req_id of each run and its row
+        self._run_ids = []
+        self._run_rows = []
+
+    def append(self, req_id, *values):
+        self._extend_runs(req_id, len(self))
+        self._append((req_id,) + values)
+
+    def _extend_runs(self, req_id, row):
+        if not self._run_ids or req_id != self._run_ids[-1] + row - self._run_rows[-1]:
+            self._run_ids.append(req_id)
+            self._run_rows.append(row)
+
+    def row(self, req_id) -> tuple:
+        """
+        The raw row of a request, with node ids, in the order of self.columns.
+        """
+        return self._row(self._find(req_id))
+
+    def value(self, req_id, name):
+        """
+        A single raw value of a request, with node ids.
+        """
+        return self._data[self._column_index[name]][self._find(req_id)]
+
+    def _find(self, req_id):
+        req_ids = self._data[0]
+        run = bisect_right(self._run_ids, req_id) - 1
+        if run >= 0:
+            row = self._run_rows[run] + req_id - self._run_ids[run]
+            if row < len(req_ids) and req_ids[row] == req_id:
+                return row
+        # req_ids not increasing
+        try:
+            return req_ids.index(req_id)
+        except ValueError:
+            raise KeyError(req_id)
+
+    def _as_dict(self, row):
+        data = {}
+        for (name, _), column in zip(self.columns[1:], self._data[1:]):
+            data[name] = self.node_labels[column[row]] if name in self.NODE_COLUMNS else column[row]
+        return data
+
+    def filter(self, mask):
+        filtered = super().filter(mask)
+        filtered._run_ids, filtered._run_rows = [], []
+        for row, req_id in enumerate(filtered._data[0]):
+            filtered._extend_runs(req_id, row)
+        return filtered
+
+    def copy(self):
+        copied = super().copy()
+        copied._run_ids, copied._run_rows = list(self._run_ids), list(self._run_rows)
+        return copied
+
+    def extend(self, other):
+        num_rows = len(self)
+        super().extend(other)
+        for row, req_id in enumerate(other._data[0], start=num_rows):
+            self._extend_runs(req_id, row)
+
+    def __getitem__(self, req_id):
+        return self._as_dict(self._find(req_id))
+
+    def __contains__(self, req_id):
+        try:
+            self._find(req_id)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self._data[0])
+
+    def keys(self):
+        return iter(self._data[0])
+
+    def values(self):
+        return (self._as_dict(row) for row in range(len(self)))
+
+    def items(self):
+        return ((req_id, self._as_dict(row)) for row, req_id in enumerate(self._data[0]))
+
+    def __eq__(self, other):
+        return len(self) == len(other) and dict(self.items()) == dict(other.items())
@@ -9,6 +9,9 @@ topologies = ["line_5", "line_10", "line_16", "line_100",
 # We investigated the differences between different shortest path modes - but it did not lead to visible differences in resulting service times
 shortest_path_modes = ["all_volume_info"]  # , "staticmin", "staticmax", "originalpaper"]
 
+# the seed of the common random numbers shared by all x (see draw_common_random_numbers), None to draw independently
+crn_seed = None
+
 # the number k of requests to simulate
 # numreqs = 1 * 10 ** 5
 # only used for wheel 16 and grids 9 and 16
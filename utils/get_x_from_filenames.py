@@ -32,3 +32,11 @@ def get_all_x(topology, mode, function):
     xrange = sorted(xrange)
 
     return xrange
+
+
+def simulation_mode(shortest_path_mode, crn_seed=None):
+    """
+    The mode as it appears in the file names of the simulations and statistics: runs with common
+    random numbers are kept apart from independent runs, and from each other, by their seed.
+    """
+    return shortest_path_mode if crn_seed is None else f"{shortest_path_mode}_crn{crn_seed}"
@@ -8,16 +8,18 @@ import dill
 
 
 def save2pickle(data, pickle_path):
+    # written next to pickle_path first and then moved, so an interruption never leaves a broken pickle behind
+    tmp_path = f"{pickle_path}.tmp"
     if pickle_path[-4:] == "dill":
-        with open(pickle_path, 'wb') as f:
+        with open(tmp_path, 'wb') as f:
             print("Saving pickle, don't interrupt!")
             dill.dump(data, f)
-            print("Pickle saved.")
     else:
-        with open(pickle_path, 'wb') as f:
+        with open(tmp_path, 'wb') as f:
             print("Saving pickle, don't interrupt!")
             pickle.dump(data, f)
-            print("Pickle saved.")
+    os.replace(tmp_path, pickle_path)
+    print("Pickle saved.")
 
 
 def pickle_loader(pickle_path):
@@ -0,0 +1,67 @@
+import os
+from array import array
+
+from .pickle_save_and_load import save2pickle, pickle_loader
+
+
+class ChunkedResultSink(object):
+    """
+    Writes the output of a simulation to directory in chunks of chunk_size requests, so that the
+    memory used by a simulation does not grow with the number of requests (see
+    ZeroDetourBus.simulate_all_requests). Every chunk is a dill file holding a tuple
+    (req_data, insertion_data, extras) like the result of simulate_single_request_rate.
+
+    Chunks from num_chunks on are removed, so that a simulation resumed from a checkpoint
+    overwrites what was written after it.
+    """
+
+    def __init__(self, directory, chunk_size=10 ** 5, num_chunks=0):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.num_chunks = num_chunks
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+            print(f"Folder '{directory}' created.")
+        for chunk_idx in range(num_chunks, len(chunk_paths(directory))):
+            os.remove(chunk_path(directory, chunk_idx))
+
+    def write(self, req_data, insertion_data, extras):
+        save2pickle((req_data, insertion_data, extras), chunk_path(self.directory, self.num_chunks))
+        self.num_chunks += 1
+
+
+def chunk_path(directory, chunk_idx):
+    return os.path.join(directory, f"chunk_{chunk_idx:05d}.dill")
+
+
+def chunk_paths(directory):
+    return sorted(os.path.join(directory, file_name) for file_name in os.listdir(directory)
+                  if file_name.startswith("chunk_") and file_name.endswith(".dill"))
+
+
+def iter_result_chunks(directory):
+    """
+    Reads the chunks written by a ChunkedResultSink back one by one.
+    """
+    for path in chunk_paths(directory):
+        yield pickle_loader(path)
+
+
+def load_chunked_result(directory):
+    """
+    Reads all chunks written by a ChunkedResultSink and joins them into a single
+    (req_data, insertion_data, extras) tuple.
+    """
+    req_data, insertion_data, extras = None, None, None
+    for chunk_req_data, chunk_insertion_data, chunk_extras in iter_result_chunks(directory):
+        if req_data is None:
+            req_data, insertion_data = chunk_req_data, chunk_insertion_data
+            extras = dict(chunk_extras,
+                          route_nodes=array('i', chunk_extras['route_nodes']),
+                          route_times=array('d', chunk_extras['route_times']))
+        else:
+            req_data.extend(chunk_req_data)
+            insertion_data.extend(chunk_insertion_data)
+            extras['route_nodes'].extend(chunk_extras['route_nodes'])
+            extras['route_times'].extend(chunk_extras['route_times'])
+    return req_data, insertion_data, extras
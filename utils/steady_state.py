@@ -0,0 +1,97 @@
+import numpy as np
+from scipy.stats import t as student_t
+
+
+class SteadyStateMonitor(object):
+    """
+    Tracks a stream of observations (e.g. the service times of the requests) online and decides
+    when their steady-state mean is known precisely enough.
+
+    The observations are averaged in batches of batch_size. The warm-up is truncated with the MSER
+    rule on these batch means, the rest is grouped into num_batches batches whose means give a
+    Student t confidence interval for the mean (method of batch means). The run has converged once
+    the half width of that interval relative to the mean is at most rel_half_width.
+    """
+
+    def __init__(self, rel_half_width=0.01, confidence=0.95, batch_size=100, num_batches=30, min_obs=5000,
+                 check_every=1000):
+        self.rel_half_width = rel_half_width
+        self.confidence = confidence
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.min_obs = min_obs
+        self.check_every = check_every
+
+        self.num_obs = 0
+        self.batch_means = []
+        self._batch_sum = 0
+
+    def add(self, value):
+        self._batch_sum += value
+        self.num_obs += 1
+        if self.num_obs % self.batch_size == 0:
+            self.batch_means.append(self._batch_sum / self.batch_size)
+            self._batch_sum = 0
+
+    def get_checkpoint(self) -> dict:
+        """
+        Returns the observations seen so far as plain data, see restore_checkpoint.
+        """
+        return dict(num_obs=self.num_obs, batch_means=list(self.batch_means), batch_sum=self._batch_sum)
+
+    def restore_checkpoint(self, checkpoint: dict):
+        """
+        Continues after the observations of a state returned by get_checkpoint.
+        """
+        self.num_obs = checkpoint['num_obs']
+        self.batch_means = list(checkpoint['batch_means'])
+        self._batch_sum = checkpoint['batch_sum']
+
+    def mser_cutoff(self) -> int:
+        """
+        Number of batch means to drop as warm-up: the d <= n/2 minimizing the MSER statistic
+        sum_{i >= d} (Y_i - mean(Y_d..))^2 / (n - d)^2.
+        """
+        batch_means = np.asarray(self.batch_means)
+        num_means = len(batch_means)
+        # sums and sums of squares of all suffixes Y_d..
+        suffix_sums = np.cumsum(batch_means[::-1])[::-1]
+        suffix_square_sums = np.cumsum(batch_means[::-1] ** 2)[::-1]
+        remaining = np.arange(num_means, 0, -1)
+        mser = (suffix_square_sums - suffix_sums ** 2 / remaining) / remaining ** 2
+        return int(np.argmin(mser[:num_means // 2 + 1]))
+
+    def estimate(self):
+        """
+        Returns the current estimate as a dict with the mean, the half width of its confidence
+        interval (absolute and relative to the mean), the warm-up cutoff (the number of leading
+        observations truncated) and the number of observations, or None if there are too few batches yet.
+        """
+        if len(self.batch_means) < 2 * self.num_batches:
+            return None
+        cutoff = self.mser_cutoff()
+        steady_means = np.asarray(self.batch_means[cutoff:])
+        # drop the leading remainder, so that the batches are of equal size
+        batches_per_batch = len(steady_means) // self.num_batches
+        cutoff += len(steady_means) - batches_per_batch * self.num_batches
+        steady_means = steady_means[-batches_per_batch * self.num_batches:]
+
+        means = steady_means.reshape(self.num_batches, batches_per_batch).mean(axis=1)
+        mean = means.mean()
+        half_width = student_t.ppf((1 + self.confidence) / 2, self.num_batches - 1) * means.std(ddof=1) / np.sqrt(
+            self.num_batches)
+        return dict(mean=mean,
+                    half_width=half_width,
+                    rel_half_width=half_width / mean if mean else np.inf,
+                    confidence=self.confidence,
+                    warmup_cutoff=cutoff * self.batch_size,
+                    num_obs=self.num_obs)
+
+    def converged(self) -> bool:
+        """
+        Checks every check_every observations whether the target precision is reached.
+        """
+        if self.num_obs < self.min_obs or self.num_obs % self.check_every:
+            return False
+        estimate = self.estimate()
+        return estimate is not None and estimate['rel_half_width'] <= self.rel_half_width